@@ -0,0 +1,1642 @@
+import contextlib
+import functools
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import os
+import queue
+import resource
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Reference point for the startup report, this module is imported first thing
+STARTUP_TIME = time.perf_counter()
+
+# Seconds since STARTUP_TIME at which each startup event happened, see record_startup_event
+STARTUP_EVENTS = {}
+
+# Seconds spent importing each lazily imported module, see lazy_import
+IMPORT_TIMES = {}
+
+
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access
+
+    Importing PyVips, SimpleITK, h5py and torch takes a good part of the cold start
+    of the container, while a handler may never need some of them. The time the
+    import takes is recorded in IMPORT_TIMES.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                IMPORT_TIMES[self._name] = time.perf_counter() - start
+                self._module = module
+        return self._module
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._module or self._load(), name)
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not imported"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+@functools.cache
+def lazy_import(name):
+    """Returns the LazyModule for the named module, shared between callers"""
+    return LazyModule(name)
+
+
+def record_startup_event(name):
+    """Records the time since startup at which the named event first happened"""
+    STARTUP_EVENTS.setdefault(name, time.perf_counter() - STARTUP_TIME)
+
+
+def report_startup_times(file=None):
+    """Writes the startup events and the time spent in lazy imports to stderr"""
+    file = file or sys.stderr
+    print("Startup report (seconds since start)", file=file)
+    for name, seconds in STARTUP_EVENTS.items():
+        print(f"\t{name}: {seconds:.3f}", file=file)
+    print("Import times (seconds)", file=file)
+    for name, seconds in IMPORT_TIMES.items():
+        print(f"\t{name}: {seconds:.3f}", file=file)
+    if not IMPORT_TIMES:
+        print("\tno lazy imports", file=file)
+
+
+def get_rss_mb():
+    """Returns the resident and the peak resident memory of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except OSError:
+        current = None
+    return current, peak
+
+
+class StageTimings:
+    """
+    Records the wall time, CPU time and memory of the stages of a run
+
+    CPU time is that of the whole process, including the threads of PyVips and
+    SimpleITK, so stages that overlap (such as concurrently loaded inputs) share
+    it. Peak RSS is the high-water mark of the process when the stage ended: the
+    stage where it jumps is the one that needed the memory.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            rss, peak_rss = get_rss_mb()
+            record = {
+                "stage": name,
+                "thread": threading.current_thread().name,
+                "start_seconds": round(wall - STARTUP_TIME, 4),
+                "wall_seconds": round(time.perf_counter() - wall, 4),
+                "cpu_seconds": round(time.process_time() - cpu, 4),
+                "rss_mb": rss and round(rss, 1),
+                "peak_rss_mb": round(peak_rss, 1),
+            }
+            with self._lock:
+                self.stages.append(record)
+
+    def write(self, path=None, **attributes):
+        """Writes the stages as JSON to path, or as a single line to stderr"""
+        content = {**attributes, "stages": self.stages}
+        if path is None:
+            print(json.dumps(content), file=sys.stderr)
+        else:
+            with open(path, "w") as f:
+                json.dump(content, f, indent=4)
+
+
+# The stages of the current run, see timed_stage
+STAGE_TIMINGS = StageTimings()
+
+
+def timed_stage(name):
+    """Context manager that records the named stage in STAGE_TIMINGS"""
+    return STAGE_TIMINGS.stage(name)
+
+
+h5py = lazy_import("h5py")
+numpy = lazy_import("numpy")
+pyvips = lazy_import("pyvips")
+SimpleITK = lazy_import("SimpleITK")
+torch = lazy_import("torch")
+
+# Extensions of the image files in a socket folder, in order of preference
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".mha", ".mrxs", ".svs", ".ndpi")
+
+# Formats that are read through OpenSlide, where pyramid levels are selected with `level`
+OPENSLIDE_EXTENSIONS = (".mrxs", ".svs", ".ndpi")
+
+# Maps the PyVips band format onto the matching NumPy dtype
+# Dtypes are spelled as strings so that NumPy is not imported at module load
+VIPS_FORMAT_TO_DTYPE = {
+    "uchar": "u1",
+    "char": "i1",
+    "ushort": "u2",
+    "short": "i2",
+    "uint": "u4",
+    "int": "i4",
+    "float": "f4",
+    "double": "f8",
+}
+
+# One record per foreground tile, in the same (level, x, y) coordinates as iter_image_tiles
+TILE_INDEX_DTYPE = [
+    ("level", "u1"),
+    ("x", "u4"),
+    ("y", "u4"),
+    ("tissue", "f4"),
+]
+
+# Number of mask pixels along a tile edge that is enough to estimate its tissue fraction
+MASK_SAMPLES_PER_TILE = 8
+
+# The file digest hashes this many evenly spaced samples of this many bytes
+DIGEST_SAMPLES = 16
+DIGEST_SAMPLE_BYTES = 1 << 20
+
+# Default location of the tile cache, /tmp is a scratch volume in the container
+DEFAULT_TILE_CACHE_DIRECTORY = Path("/tmp/tile-cache")
+
+# The tile cache rescans its directory after writing this fraction of its budget,
+# to account for the tiles written by other processes
+TILE_CACHE_SCAN_FRACTION = 0.05
+
+# Maps the MetaImage element type onto the matching NumPy dtype (little endian)
+MHA_ELEMENT_TYPE_TO_DTYPE = {
+    "MET_UCHAR": "u1",
+    "MET_CHAR": "i1",
+    "MET_USHORT": "<u2",
+    "MET_SHORT": "<i2",
+    "MET_UINT": "<u4",
+    "MET_INT": "<i4",
+    "MET_ULONG_LONG": "<u8",
+    "MET_LONG_LONG": "<i8",
+    "MET_FLOAT": "<f4",
+    "MET_DOUBLE": "<f8",
+}
+
+# The MetaImage header is plain text and ends well within this many bytes
+MHA_MAX_HEADER_BYTES = 1 << 16
+
+# Normalization the encoders are trained with, per RGB channel
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# A radiology volume: the voxels in (z, y, x) order and the physical metadata in
+# SimpleITK (x, y, z) order, direction being a flattened row-major matrix
+Volume = namedtuple("Volume", ["array", "spacing", "origin", "direction"])
+
+# An image file of an input socket: its path, its format (the extension) and its size in bytes
+ImageFile = namedtuple("ImageFile", ["path", "format", "size"])
+
+
+def open_image_level(file_path, *, level=0):
+    """
+    Opens a single pyramid level of a whole slide image without decoding any pixels
+
+    Level 0 is the full resolution image. For OpenSlide formats the level is
+    an OpenSlide level, for (pyramidal) TIFF files it is the TIFF page.
+    """
+    file_path = str(file_path)
+    if Path(file_path).suffix.lower() in OPENSLIDE_EXTENSIONS:
+        return pyvips.Image.openslideload(file_path, level=level)
+    if level == 0:
+        return pyvips.Image.new_from_file(file_path)
+    return pyvips.Image.tiffload(file_path, page=level)
+
+
+def get_level_count(file_path):
+    # Number of pyramid levels (OpenSlide levels or TIFF pages) in the image
+    image = pyvips.Image.new_from_file(str(file_path))
+    if Path(file_path).suffix.lower() in OPENSLIDE_EXTENSIONS:
+        return int(image.get("openslide.level-count"))
+    if image.get_typeof("n-pages"):
+        return image.get("n-pages")
+    return 1
+
+
+def open_smallest_level(file_path, *, min_width):
+    """
+    Opens the smallest pyramid level that is still at least min_width pixels wide
+
+    Falls back to level 0 if the image has no level that is wide enough.
+    """
+    image = open_image_level(file_path, level=0)
+    for level in range(1, get_level_count(file_path)):
+        candidate = open_image_level(file_path, level=level)
+        if candidate.width < min_width:
+            break
+        image = candidate
+    return image
+
+
+def iter_image_tiles(
+    image, *, tile_size, level=0, tile_index=None, tile_cache=None, digest=None
+):
+    """
+    A generator that yields (level, x, y, tile) for every tile of a PyVips image
+
+    Tiles are fetched one by one through a PyVips region, so only the pixels of a
+    single tile are decoded and held in memory at any time. The x and y are the
+    top-left corner of the tile in the coordinates of the level. Tiles on the
+    right and bottom border are zero-padded to tile_size x tile_size.
+
+    If a tile_index (see build_tissue_tile_index) is given, only the tiles listed
+    in it are read. It must have been built for the same level and tile_size.
+
+    If a tile_cache (see TileCache) is given, tiles are looked up by the digest of
+    the image file first and only decoded on a miss.
+    """
+    region = pyvips.Region.new(image)
+
+    if tile_index is not None:
+        coordinates = zip(tile_index["x"].tolist(), tile_index["y"].tolist())
+    else:
+        coordinates = (
+            (x, y)
+            for y in range(0, image.height, tile_size)
+            for x in range(0, image.width, tile_size)
+        )
+
+    for x, y in coordinates:
+        key = (digest, level, x, y, tile_size)
+        tile = tile_cache.get(key) if tile_cache is not None else None
+        if tile is None:
+            tile = fetch_tile(
+                region=region, image=image, x=x, y=y, tile_size=tile_size
+            )
+            if tile_cache is not None:
+                tile_cache.put(key, tile)
+        yield level, x, y, tile
+
+
+def fetch_tile(*, region, image, x, y, tile_size):
+    # Reads a single tile from a region, clipped to the image and padded back to tile_size
+    width = min(tile_size, image.width - x)
+    height = min(tile_size, image.height - y)
+    dtype = VIPS_FORMAT_TO_DTYPE[image.format]
+
+    pixels = numpy.frombuffer(region.fetch(x, y, width, height), dtype=dtype)
+    pixels = pixels.reshape((height, width, image.bands))
+
+    if width != tile_size or height != tile_size:
+        tile = numpy.zeros((tile_size, tile_size, image.bands), dtype=dtype)
+        tile[:height, :width] = pixels
+    else:
+        tile = pixels
+
+    if image.bands == 1:
+        # Grayscale image, same convention as load_image_file_as_array
+        return tile[:, :, 0]
+    return tile
+
+
+def build_tissue_tile_index(
+    *, image_path, mask_path, tile_size, level=0, min_tissue=0.1
+):
+    """
+    Lists the tiles of a whole slide image that contain tissue
+
+    The tissue fraction of every tile is computed on a low resolution level of the
+    tissue mask, mapped onto the tile grid of the requested slide level, so the
+    full resolution mask is never decoded. A mask without reduced levels (not
+    pyramidal, or with its pyramid in SubIFDs) is shrunk while it is read instead.
+    Tiles with a tissue fraction of at least min_tissue are returned, in the same
+    order as iter_image_tiles, as a structured array of TILE_INDEX_DTYPE.
+    """
+    image = open_image_level(image_path, level=level)
+    columns = -(-image.width // tile_size)
+    rows = -(-image.height // tile_size)
+
+    min_width = columns * MASK_SAMPLES_PER_TILE
+    has_levels = get_level_count(mask_path) > 1
+    if has_levels:
+        mask = open_smallest_level(mask_path, min_width=min_width)
+    else:
+        mask = pyvips.Image.thumbnail(str(mask_path), min_width, size="down")
+    if mask.bands > 1:
+        mask = mask[0]
+    values = numpy.ndarray(
+        buffer=mask.write_to_memory(),
+        dtype=VIPS_FORMAT_TO_DTYPE[mask.format],
+        shape=(mask.height, mask.width),
+    )
+    if has_levels:
+        foreground = values > 0
+    else:
+        # Shrinking blends the mask values at the tissue border, take the majority
+        foreground = values > values.max() / 2
+
+    # Summed-area table, so the foreground count of any box is four lookups
+    summed = numpy.zeros((mask.height + 1, mask.width + 1), dtype=numpy.int64)
+    summed[1:, 1:] = foreground.cumsum(axis=0).cumsum(axis=1)
+
+    # Tile edges in slide level coordinates, mapped onto mask pixels
+    x_edges = numpy.minimum(numpy.arange(columns + 1) * tile_size, image.width)
+    y_edges = numpy.minimum(numpy.arange(rows + 1) * tile_size, image.height)
+    x_mask = numpy.floor(x_edges * (mask.width / image.width)).astype(numpy.int64)
+    y_mask = numpy.floor(y_edges * (mask.height / image.height)).astype(numpy.int64)
+    x0, x1 = x_mask[:-1], numpy.maximum(x_mask[1:], x_mask[:-1] + 1)
+    y0, y1 = y_mask[:-1, None], numpy.maximum(y_mask[1:], y_mask[:-1] + 1)[:, None]
+    x1 = numpy.minimum(x1, mask.width)
+    y1 = numpy.minimum(y1, mask.height)
+
+    counts = summed[y1, x1] - summed[y0, x1] - summed[y1, x0] + summed[y0, x0]
+    tissue = counts / ((y1 - y0) * (x1 - x0))
+
+    tile_rows, tile_columns = numpy.nonzero((tissue > 0) & (tissue >= min_tissue))
+
+    tile_index = numpy.empty(len(tile_rows), dtype=TILE_INDEX_DTYPE)
+    tile_index["level"] = level
+    tile_index["x"] = tile_columns * tile_size
+    tile_index["y"] = tile_rows * tile_size
+    tile_index["tissue"] = tissue[tile_rows, tile_columns]
+    return tile_index
+
+
+class InputManifest:
+    """
+    The image files of all input sockets, discovered in a single pass
+
+    Built from inputs.json plus one os.scandir per socket folder, so the loaders
+    look files up instead of each globbing the folder again. When a socket folder
+    holds more than one image file, the first in IMAGE_EXTENSIONS order and then
+    by name is used, whatever order the file system lists them in. Folders that
+    are not in inputs.json are scanned on first use.
+
+    Without locations (there is no inputs.json, e.g. when a loader is used on its
+    own) the manifest only scans folders on first use and has no socket slugs.
+    """
+
+    def __init__(self, input_path, *, locations=None):
+        self.input_path = Path(input_path)
+        # Maps each socket slug onto its location: a folder for images, a file otherwise
+        self.locations = locations
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_inputs_json(cls, input_path):
+        input_path = Path(input_path)
+        with open(input_path / "inputs.json", "r") as f:
+            inputs = json.load(f)
+
+        manifest = cls(
+            input_path,
+            locations={
+                sv["interface"]["slug"]: input_path
+                / (sv["interface"].get("relative_path") or f"images/{sv['interface']['slug']}")
+                for sv in inputs
+            },
+        )
+        for location in manifest.locations.values():
+            manifest.get_files(location)
+        return manifest
+
+    @property
+    def slugs(self):
+        if self.locations is None:
+            raise FileNotFoundError(f"No inputs.json in {self.input_path}")
+        return tuple(self.locations)
+
+    def __getitem__(self, slug):
+        # The image files of a socket
+        return self.get_files(self.locations[slug])
+
+    def get_files(self, location):
+        """Returns the ImageFiles in the location folder, preferred file first"""
+        location = Path(location)
+        with self._lock:
+            if location not in self._files:
+                self._files[location] = self._scan(location)
+            return self._files[location]
+
+    def get_image_file_path(self, location):
+        """Returns the path of the preferred image file in the location folder"""
+        files = self.get_files(location)
+        if not files:
+            raise FileNotFoundError(f"No compatible image files found in {location}")
+        if len(files) > 1:
+            print(f"Found {len(files)} image files in {location}, using {files[0].path.name}")
+        return files[0].path
+
+    @staticmethod
+    def _scan(location):
+        try:
+            with os.scandir(location) as entries:
+                files = [
+                    ImageFile(
+                        path=Path(entry.path),
+                        format=Path(entry.name).suffix.lower(),
+                        size=entry.stat().st_size,
+                    )
+                    for entry in entries
+                    if Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS and entry.is_file()
+                ]
+        except (FileNotFoundError, NotADirectoryError):
+            # Not an image socket, such as a JSON value
+            return ()
+        return tuple(
+            sorted(files, key=lambda f: (IMAGE_EXTENSIONS.index(f.format), f.path.name))
+        )
+
+
+# Root of the cgroup file system, where the limits of the container can be read
+CGROUP_PATH = Path("/sys/fs/cgroup")
+
+# The CPUs and memory (in bytes) that this container may use, see get_resources
+Resources = namedtuple("Resources", ["cpus", "memory_limit", "memory_available"])
+
+
+def _read_cgroup_file(*parts):
+    try:
+        return (CGROUP_PATH.joinpath(*parts)).read_text().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_limit():
+    """Returns the CPU quota of the cgroup (v2 or v1) in cores, or None if there is none"""
+    if cpu_max := _read_cgroup_file("cpu.max"):
+        quota, _, period = cpu_max.partition(" ")
+        return None if quota == "max" else int(quota) / int(period or 100000)
+
+    quota = _read_cgroup_file("cpu", "cpu.cfs_quota_us")
+    period = _read_cgroup_file("cpu", "cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def get_cgroup_memory():
+    """
+    Returns the memory limit of the cgroup (v2 or v1) and the memory it uses, in bytes
+
+    The limit is None if there is none. Inactive page cache is not counted as
+    used, as the kernel reclaims it before the limit is hit.
+    """
+    if (limit := _read_cgroup_file("memory.max")) is not None:
+        usage, stat, inactive_field = (
+            _read_cgroup_file("memory.current"),
+            _read_cgroup_file("memory.stat"),
+            "inactive_file",
+        )
+    else:
+        limit, usage, stat, inactive_field = (
+            _read_cgroup_file("memory", "memory.limit_in_bytes"),
+            _read_cgroup_file("memory", "memory.usage_in_bytes"),
+            _read_cgroup_file("memory", "memory.stat"),
+            "total_inactive_file",
+        )
+
+    # Without a limit, v2 reports "max" and v1 a number close to 2**63
+    limit = int(limit) if limit and limit != "max" and int(limit) < 1 << 60 else None
+    usage = int(usage) if usage else 0
+    for line in (stat or "").splitlines():
+        key, _, value = line.partition(" ")
+        if key == inactive_field:
+            usage -= int(value)
+    return limit, max(usage, 0)
+
+
+def get_resources():
+    """
+    Returns the Resources of this container, from its cgroup (v1 or v2) limits
+
+    cpus is the CPU quota rounded up, at most the number of CPUs this process may
+    run on. memory_limit is the cgroup limit or else the physical memory, and
+    memory_available what is left of it, at most the MemAvailable of the host.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if quota := get_cgroup_cpu_limit():
+        cpus = min(cpus, -(-quota // 1))
+
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                meminfo[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+
+    limit, usage = get_cgroup_memory()
+    memory_limit = limit or meminfo.get("MemTotal")
+    memory_available = meminfo.get("MemAvailable")
+    if limit:
+        memory_available = min(memory_available or limit, limit - usage)
+
+    return Resources(
+        cpus=max(1, int(cpus or 1)),
+        memory_limit=memory_limit,
+        memory_available=memory_available,
+    )
+
+
+@functools.cache
+def configure_resources():
+    """
+    Sizes the thread pools of libvips, ITK (SimpleITK) and torch to the CPU quota
+
+    Each library otherwise starts a thread per core of the host, so several of
+    them oversubscribe a container that may only use a few cores. Thread counts
+    that are already set in the environment (VIPS_CONCURRENCY,
+    ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS, OMP_NUM_THREADS) are kept. Runs once
+    per process and logs the chosen values; returns the Resources.
+    """
+    resources = get_resources()
+    for variable in ("VIPS_CONCURRENCY", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS"):
+        os.environ.setdefault(variable, str(resources.cpus))
+
+    # Libraries that are imported already have read the environment
+    if "pyvips" in sys.modules:
+        pyvips.concurrency_set(int(os.environ["VIPS_CONCURRENCY"]))
+    if "SimpleITK" in sys.modules:
+        SimpleITK.ProcessObject.SetGlobalDefaultNumberOfThreads(
+            int(os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"])
+        )
+    if "torch" in sys.modules:
+        torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+
+    def gigabytes(n):
+        return f"{n / (1 << 30):.1f} GB" if n else "unknown"
+
+    print("=+=" * 10)
+    print("Resources")
+    print(f"\tCPUs: {resources.cpus} (cgroup quota: {get_cgroup_cpu_limit() or 'none'})")
+    print(f"\tmemory: {gigabytes(resources.memory_available)} available of {gigabytes(resources.memory_limit)}")
+    print(f"\tlibvips threads: {os.environ['VIPS_CONCURRENCY']}")
+    print(f"\tSimpleITK threads: {os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']}")
+    print(f"\ttorch threads: {os.environ['OMP_NUM_THREADS']} intra-op")
+    print(f"\tinput loading threads: {get_max_load_workers()}")
+    print(f"\tmemory budget: {gigabytes(get_memory_budget())}")
+    print("=+=" * 10)
+    return resources
+
+
+def get_max_load_workers():
+    """
+    Returns the maximum number of threads used to load input sockets concurrently
+
+    Loading is mostly I/O and decoding in PyVips and SimpleITK, which release the
+    GIL, so this may exceed the number of CPUs of the container (see get_resources).
+
+    To limit this, set INPUT_LOAD_MAX_WORKERS
+    """
+    environ_limit = os.getenv("INPUT_LOAD_MAX_WORKERS")
+    return int(environ_limit or min(32, get_resources().cpus + 4))
+
+
+# Part of the available memory that image data may use, the rest is left to the model,
+# the interpreter and the page cache; set MEMORY_BUDGET_MB to override
+MEMORY_BUDGET_FRACTION = 0.5
+
+# Parts of the memory budget for the thumbnails of a case and for feature extraction
+THUMBNAIL_MEMORY_SHARE = 0.25
+FEATURE_MEMORY_SHARE = 0.25
+
+# Thumbnails are never smaller than the size used before there was a budget
+THUMBNAIL_MIN_SIZE = 1024
+THUMBNAIL_MAX_SIZE = 8192
+
+# Bytes per pixel of a thumbnail, OpenSlide images are RGBA
+THUMBNAIL_BYTES_PER_PIXEL = 4
+
+# Rough bytes per tile pixel while encoding: the uint8 tile, its float32 copies and the
+# activations of the encoder
+FEATURE_BYTES_PER_PIXEL = 48
+
+FEATURE_BATCH_SIZES = (16, 512)
+FEATURE_PREFETCH_BATCHES = (1, 8)
+
+
+def get_memory_budget(*, share=1.0):
+    """
+    Returns the bytes of memory that image data may use, times share
+
+    This is MEMORY_BUDGET_MB if set, else MEMORY_BUDGET_FRACTION of the memory
+    available to the container (see get_resources). Returns None if unknown.
+    """
+    if environ_budget := os.getenv("MEMORY_BUDGET_MB"):
+        return int(float(environ_budget) * (1 << 20) * share)
+    available = get_resources().memory_available
+    if available is None:
+        return None
+    return int(available * MEMORY_BUDGET_FRACTION * share)
+
+
+def get_thumbnail_max_size(*, memory_budget=None):
+    """
+    Returns the largest thumbnail width and height that fits in memory_budget bytes
+
+    The size is a multiple of THUMBNAIL_MIN_SIZE, from THUMBNAIL_MIN_SIZE up to
+    THUMBNAIL_MAX_SIZE, so larger containers get more detailed thumbnails. Without a
+    budget this is THUMBNAIL_MIN_SIZE.
+    """
+    if not memory_budget:
+        return THUMBNAIL_MIN_SIZE
+    size = math.isqrt(memory_budget // THUMBNAIL_BYTES_PER_PIXEL)
+    size = size // THUMBNAIL_MIN_SIZE * THUMBNAIL_MIN_SIZE
+    return min(THUMBNAIL_MAX_SIZE, max(THUMBNAIL_MIN_SIZE, size))
+
+
+def get_feature_batching(*, tile_size, memory_budget=None):
+    """
+    Returns the batch size and prefetch depth of a FeatureExtractor for memory_budget bytes
+
+    Parameters
+    ----------
+    tile_size : int
+        Width and height of the tiles in pixels.
+    memory_budget : int, optional
+        Bytes for feature extraction, half for the batch being encoded and half for the
+        batches waiting in the queue. Without a budget, the FeatureExtractor defaults.
+
+    Returns
+    -------
+    tuple of int
+        The batch size, a power of two within FEATURE_BATCH_SIZES, and the number of
+        prefetched batches, within FEATURE_PREFETCH_BATCHES.
+    """
+    if not memory_budget:
+        return 64, 2
+    pixels = tile_size * tile_size
+    batch_size = memory_budget // 2 // (pixels * FEATURE_BYTES_PER_PIXEL)
+    batch_size = 1 << max(0, batch_size.bit_length() - 1)
+    batch_size = min(FEATURE_BATCH_SIZES[1], max(FEATURE_BATCH_SIZES[0], batch_size))
+
+    # Waiting batches only hold the uint8 RGB tiles
+    prefetch_batches = memory_budget // 2 // (batch_size * pixels * 3)
+    prefetch_batches = min(FEATURE_PREFETCH_BATCHES[1], max(FEATURE_PREFETCH_BATCHES[0], prefetch_batches))
+    return int(batch_size), int(prefetch_batches)
+
+
+def load_inputs_concurrently(*, loaders, max_workers=None):
+    """
+    Runs the loaders of all input sockets concurrently on a bounded thread pool
+
+    Parameters
+    ----------
+    loaders : dict
+        Maps a name onto a callable without arguments that loads one input
+
+    max_workers : int, optional
+        Number of loading threads, defaults to get_max_load_workers()
+
+    Returns
+    -------
+    A dict with the loaded inputs, under the same names as the loaders
+
+    If a loader fails, loaders that did not start yet are canceled and the
+    error is raised.
+    """
+    max_workers = min(max_workers or get_max_load_workers(), len(loaders)) or 1
+
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="InputLoading"
+    ) as executor:
+        futures = {name: executor.submit(loader) for name, loader in loaders.items()}
+        try:
+            return {name: future.result() for name, future in futures.items()}
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def get_file_digest(file_path):
+    """
+    Returns a fast content digest of a (large) image file
+
+    Only the file size and DIGEST_SAMPLES evenly spaced samples of the file,
+    including its start and end, are hashed. This tells slides apart in
+    milliseconds, even for slides of tens of GB, but is not a checksum. For
+    MIRAX the Slidedat.ini in the data directory next to the .mrxs is included.
+    """
+    file_path = Path(file_path)
+    stat = file_path.stat()
+    return _get_file_digest(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.cache
+def _get_file_digest(file_path, size, mtime_ns):
+    # Cached per process on path, size and modification time
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, "rb") as f:
+        stride = max(size - DIGEST_SAMPLE_BYTES, 0) // max(DIGEST_SAMPLES - 1, 1)
+        for sample in range(DIGEST_SAMPLES):
+            f.seek(sample * stride)
+            digest.update(f.read(DIGEST_SAMPLE_BYTES))
+
+    slidedat = Path(file_path).with_suffix("") / "Slidedat.ini"
+    if Path(file_path).suffix.lower() == ".mrxs" and slidedat.is_file():
+        digest.update(slidedat.read_bytes())
+
+    return digest.hexdigest()
+
+
+class TileCache:
+    """
+    A persistent, content-addressed cache of decoded tiles on disk
+
+    Tiles are stored as uncompressed .npy files, keyed by (file digest, level, x, y,
+    tile size), so repeated runs over the same slides skip decoding them. When the
+    total size exceeds max_bytes, the least recently used tiles are evicted. Recency
+    is kept in the file modification times, so it survives between runs.
+
+    max_bytes is the budget of the directory, which may be shared by processes (as
+    in batch mode). Each cache rescans the directory after it writes
+    TILE_CACHE_SCAN_FRACTION of the budget, so the directory exceeds the budget by at
+    most that fraction per process. Eviction goes down to that fraction below the
+    budget, so that a full cache does not evict (or rescan) on every tile it writes.
+    """
+
+    def __init__(self, *, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._total_bytes = 0
+        self._unscanned_bytes = 0  # Written since the last scan
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # Rebuilds the entries from the directory, with the tiles of all processes
+        existing = []
+        for path in self.directory.glob("*/*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            existing.append((stat.st_mtime_ns, path, stat.st_size))
+
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(existing))
+        self._total_bytes = sum(self._entries.values())
+        self._unscanned_bytes = 0
+
+    def _get_path(self, key):
+        digest, level, x, y, tile_size = key
+        return self.directory / digest[:2] / f"{digest}-{level}-{x}-{y}-{tile_size}.npy"
+
+    def get(self, key):
+        # Returns the cached tile, or None on a miss
+        path = self._get_path(key)
+        try:
+            tile = numpy.load(path, allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # Evicted by another process since, the loaded tile is still good
+
+        with self._lock:
+            self.hits += 1
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        return tile
+
+    def put(self, key, tile):
+        path = self._get_path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        # Write next to the target and rename, so readers never see a partial tile
+        temporary_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary_path, "wb") as f:
+            numpy.save(f, tile, allow_pickle=False)
+            size = f.tell()
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._unscanned_bytes += size
+            if self._unscanned_bytes > self.max_bytes * TILE_CACHE_SCAN_FRACTION:
+                self._scan()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evicts down to a low-water mark, so the next tiles fit without evicting again
+        low_water_bytes = self.max_bytes * (1 - TILE_CACHE_SCAN_FRACTION)
+        while self._total_bytes > low_water_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass  # Evicted by another process
+
+
+@functools.cache
+def get_tile_cache():
+    """
+    Returns the tile cache shared by the WSI loaders, or None if it is disabled
+
+    The cache is opt-in: set TILE_CACHE_MAX_BYTES to its byte budget to enable it,
+    and optionally TILE_CACHE_DIRECTORY (defaults to /tmp/tile-cache).
+    """
+    max_bytes = int(os.getenv("TILE_CACHE_MAX_BYTES") or 0)
+    if not max_bytes:
+        return None
+    directory = os.getenv("TILE_CACHE_DIRECTORY") or DEFAULT_TILE_CACHE_DIRECTORY
+    return TileCache(directory=directory, max_bytes=max_bytes)
+
+
+def read_mha_header(file_path):
+    """
+    Reads the header of a MetaImage (.mha) file
+
+    Returns the header fields as a dict of strings, and the byte offset at which
+    the pixel data starts (right after ElementDataFile, the last field).
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(MHA_MAX_HEADER_BYTES)
+
+    header = {}
+    offset = 0
+    for line in head.splitlines(keepends=True):
+        offset += len(line)
+        key, _, value = line.decode("latin-1").partition("=")
+        header[key.strip()] = value.strip()
+        if key.strip() == "ElementDataFile":
+            return header, offset
+
+    raise ValueError(f"No ElementDataFile found in the header of {file_path}")
+
+
+def load_mha_volume(file_path):
+    """
+    Loads a MetaImage (.mha) volume without copying its voxels
+
+    Uncompressed files with local data are memory-mapped, so voxels are only read
+    from disk when they are accessed. Other files are read with SimpleITK and
+    returned as a view on the SimpleITK buffer instead of a copy. Either way the
+    returned array is read-only, copy it if it needs to be modified.
+    """
+    header, offset = read_mha_header(file_path)
+    if not _can_memory_map(header):
+        return _load_volume_with_simpleitk(file_path)
+
+    shape, spacing, origin, direction = _get_mha_geometry(header)
+    dtype = MHA_ELEMENT_TYPE_TO_DTYPE[header["ElementType"]]
+    return Volume(
+        array=numpy.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape),
+        spacing=spacing,
+        origin=origin,
+        direction=direction,
+    )
+
+
+def _can_memory_map(header):
+    # Whether the voxels follow the header as raw little endian data of a known type
+    # The byte order is BinaryDataByteOrderMSB or its alias ElementByteOrderMSB
+    big_endian = any(
+        value.lower() == "true" for key, value in header.items() if key.endswith("ByteOrderMSB")
+    )
+    return (
+        header.get("ElementType") in MHA_ELEMENT_TYPE_TO_DTYPE
+        and header.get("ElementDataFile") == "LOCAL"
+        and header.get("CompressedData", "False").lower() != "true"
+        and header.get("BinaryData", "True").lower() != "false"
+        and not big_endian
+    )
+
+
+def _get_mha_geometry(header):
+    # The array shape and the spacing, origin and direction of a MetaImage header
+    dimensions = [int(d) for d in header["DimSize"].split()]
+    shape = tuple(reversed(dimensions))
+    channels = int(header.get("ElementNumberOfChannels", 1))
+    if channels > 1:
+        shape += (channels,)
+
+    ndims = len(dimensions)
+    transform = (
+        header.get("TransformMatrix")
+        or header.get("Rotation")
+        or header.get("Orientation")
+    )
+    if transform:
+        # MetaImage stores the direction matrix column by column
+        direction = numpy.array(transform.split(), dtype=float).reshape(ndims, ndims)
+        direction = tuple(direction.T.ravel().tolist())
+    else:
+        direction = tuple(numpy.eye(ndims).ravel().tolist())
+    origin = header.get("Offset") or header.get("Origin") or header.get("Position")
+
+    return (
+        shape,
+        tuple(float(v) for v in header["ElementSpacing"].split()),
+        tuple(float(v) for v in origin.split()) if origin else (0.0,) * ndims,
+        direction,
+    )
+
+
+def get_mask_bounding_box(mask, *, margin=0.0):
+    """
+    Returns the physical corners of the box around the nonzero voxels of a mask
+
+    Parameters
+    ----------
+    mask : Volume
+        A 3D mask, as loaded by load_mha_volume
+    margin : float
+        Grows the box by this many millimetres on every side
+
+    Returns
+    -------
+    numpy.ndarray or None
+        The (8, 3) physical (x, y, z) points of the corners of the box, so that it
+        can be mapped onto volumes on another grid, or None if the mask is empty
+    """
+    array = numpy.asarray(mask.array)
+    extents = []
+    for axis in range(3):
+        # Array axis 0 is z, so physical axis x is array axis 2
+        other_axes = tuple(a for a in range(3) if a != 2 - axis)
+        nonzero = numpy.flatnonzero(array.any(axis=other_axes))
+        if not len(nonzero):
+            return None
+        grow = margin / mask.spacing[axis]
+        extents.append((nonzero[0] - grow, nonzero[-1] + grow))
+
+    indices = numpy.array(list(itertools.product(*extents)), dtype=float)
+    direction = numpy.array(mask.direction).reshape(3, 3)
+    return numpy.array(mask.origin) + (indices * mask.spacing) @ direction.T
+
+
+def load_mha_region(file_path, *, bounding_box):
+    """
+    Loads only the voxels of a MetaImage (.mha) volume inside a physical box
+
+    The box, such as from get_mask_bounding_box, is mapped onto the grid of this
+    volume and clipped to it. Uncompressed files are memory-mapped and sliced;
+    others are read with the region extraction of SimpleITK's ImageFileReader.
+    The origin of the returned Volume is that of the first voxel of the region,
+    so the physical position of every voxel is unchanged. Without a box, or if
+    it misses the volume, the whole volume is loaded.
+    """
+    header, offset = read_mha_header(file_path)
+    shape, spacing, origin, direction = _get_mha_geometry(header)
+    if bounding_box is None:
+        return load_mha_volume(file_path)
+
+    matrix = numpy.array(direction).reshape(3, 3)
+    indices = ((numpy.asarray(bounding_box) - origin) @ matrix) / spacing
+    size = numpy.array(list(reversed(shape[:3])))
+    start = numpy.clip(numpy.floor(indices.min(axis=0) + 1e-6).astype(int), 0, size)
+    stop = numpy.clip(numpy.ceil(indices.max(axis=0) - 1e-6).astype(int) + 1, 0, size)
+    if numpy.any(stop <= start):
+        print(f"The bounding box misses {file_path}, loading the whole volume")
+        return load_mha_volume(file_path)
+
+    region_origin = tuple((numpy.array(origin) + matrix @ (start * spacing)).tolist())
+    if _can_memory_map(header):
+        volume = load_mha_volume(file_path)
+        (x0, y0, z0), (x1, y1, z1) = start, stop
+        return volume._replace(array=volume.array[z0:z1, y0:y1, x0:x1], origin=region_origin)
+
+    reader = SimpleITK.ImageFileReader()
+    reader.SetFileName(str(file_path))
+    reader.SetExtractIndex(start.tolist())
+    reader.SetExtractSize((stop - start).tolist())
+    image = reader.Execute()
+    return Volume(
+        array=numpy.asarray(_SimpleITKBuffer(image)),
+        spacing=image.GetSpacing(),
+        origin=region_origin,
+        direction=image.GetDirection(),
+    )
+
+
+# SimpleITK interpolators by name, see resample_volume
+INTERPOLATORS = {
+    "linear": "sitkLinear",
+    "nearest": "sitkNearestNeighbor",
+    "bspline": "sitkBSpline",
+}
+
+
+def resample_volume(volume, *, reference, interpolator="linear", num_threads=None):
+    """
+    Resamples a Volume onto the grid of a reference Volume with SimpleITK
+
+    Use "linear" (or "bspline") interpolation for images and "nearest" for masks,
+    so that labels keep their values. Voxels outside of the volume become 0. The
+    filter is multithreaded, with num_threads threads or SimpleITK's default. A
+    volume that is already on the grid of the reference is returned as is.
+    """
+    if _get_grid(volume) == _get_grid(reference):
+        return volume
+
+    resampler = SimpleITK.ResampleImageFilter()
+    resampler.SetSize(list(reversed(reference.array.shape[:3])))
+    resampler.SetOutputSpacing(reference.spacing)
+    resampler.SetOutputOrigin(reference.origin)
+    resampler.SetOutputDirection(reference.direction)
+    resampler.SetInterpolator(getattr(SimpleITK, INTERPOLATORS[interpolator]))
+    resampler.SetDefaultPixelValue(0)
+    if num_threads:
+        resampler.SetNumberOfThreads(num_threads)
+
+    image = resampler.Execute(_volume_to_image(volume))
+    return Volume(
+        array=numpy.asarray(_SimpleITKBuffer(image)),
+        spacing=image.GetSpacing(),
+        origin=image.GetOrigin(),
+        direction=image.GetDirection(),
+    )
+
+
+def _get_grid(volume):
+    # The voxel grid of a volume, rounded so that header round trips compare equal
+    return (
+        volume.array.shape[:3],
+        tuple(round(v, 6) for v in volume.spacing),
+        tuple(round(v, 6) for v in volume.origin),
+        tuple(round(v, 6) for v in volume.direction),
+    )
+
+
+def _volume_to_image(volume):
+    array = numpy.ascontiguousarray(volume.array)
+    image = SimpleITK.GetImageFromArray(array, isVector=array.ndim > 3)
+    image.SetSpacing(volume.spacing)
+    image.SetOrigin(volume.origin)
+    image.SetDirection(volume.direction)
+    return image
+
+
+class _SimpleITKBuffer:
+    # Exposes the pixel buffer of a SimpleITK image to NumPy, and keeps the image
+    # alive for as long as any array created from it
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = SimpleITK.GetArrayViewFromImage(
+            image
+        ).__array_interface__
+
+
+def _load_volume_with_simpleitk(file_path):
+    image = SimpleITK.ReadImage(str(file_path))
+    return Volume(
+        array=numpy.asarray(_SimpleITKBuffer(image)),
+        spacing=image.GetSpacing(),
+        origin=image.GetOrigin(),
+        direction=image.GetDirection(),
+    )
+
+
+class LazyInput:
+    """
+    An input socket that is only loaded on first access, after which it is cached
+
+    Attribute access, indexing, iteration, len(), truth testing and numpy.asarray()
+    are forwarded to the loaded object, so a LazyInput can mostly be used in place
+    of it. Use load() to get the loaded object itself. Loading is thread-safe.
+    """
+
+    def __init__(self, loader, *, name=None):
+        self._loader = loader
+        self._name = name
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._value = None
+
+    @property
+    def is_loaded(self):
+        return self._loaded
+
+    def load(self):
+        with self._lock:
+            if not self._loaded:
+                with timed_stage(f"load {self._name or repr(self._loader)}"):
+                    self._value = self._loader()
+                self._loaded = True
+        return self._value
+
+    def __getattr__(self, name):
+        # Only called for attributes that LazyInput itself does not have
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __bool__(self):
+        return bool(self.load())
+
+    def __array__(self, dtype=None, copy=None):
+        return numpy.asarray(self.load(), dtype=dtype)
+
+    def __repr__(self):
+        if self._loaded:
+            return f"LazyInput({self._value!r})"
+        return f"LazyInput(<not loaded: {self._loader!r}>)"
+
+
+def load_inputs_lazily(*, loaders):
+    """
+    Wraps the loaders of all input sockets in LazyInputs, without loading anything
+
+    Parameters
+    ----------
+    loaders : dict
+        Maps a name onto a callable without arguments that loads one input
+
+    Returns
+    -------
+    A dict with a LazyInput per input, under the same names as the loaders
+    """
+    return {name: LazyInput(loader, name=name) for name, loader in loaders.items()}
+
+
+def prefetch_inputs(inputs, *, names, max_workers=None):
+    """
+    Loads the named LazyInputs concurrently (see load_inputs_concurrently)
+
+    Names that are not among the inputs of the interface are ignored.
+    """
+    load_inputs_concurrently(
+        loaders={name: inputs[name].load for name in names if name in inputs},
+        max_workers=max_workers,
+    )
+
+
+def load_encoder(model_path, *, num_threads=None):
+    """
+    Loads a patch encoder for inference on the CPU
+
+    The encoder is a TorchScript module, or a torch.export program if the file
+    ends in .pt2. It takes a float batch of normalized RGB tiles (N, 3, H, W) and
+    returns one feature vector per tile. num_threads sets the torch intra-op threads,
+    which default to OMP_NUM_THREADS or the CPUs of the container.
+    """
+    torch.set_num_threads(num_threads or int(os.getenv("OMP_NUM_THREADS") or get_resources().cpus))
+    try:
+        # Tiles are encoded one batch at a time, there are no independent ops to overlap
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before any inter-op work started, e.g. by an earlier encoder
+        pass
+    print(
+        f"Torch threads: {torch.get_num_threads()} intra-op, "
+        f"{torch.get_num_interop_threads()} inter-op"
+    )
+
+    if Path(model_path).suffix == ".pt2":
+        return torch.export.load(str(model_path)).module()
+
+    encoder = torch.jit.load(str(model_path), map_location="cpu")
+    encoder.eval()
+    return encoder
+
+
+@functools.cache
+def get_encoder(model_path, *, num_threads=None):
+    """
+    Returns the encoder at model_path, loaded once per process with load_encoder
+
+    Batch and server mode process many cases in one process, so the weights are
+    only read once. Forked batch workers share the encoder of their parent.
+    """
+    with timed_stage(f"model load {Path(model_path).name}"):
+        return load_encoder(model_path, num_threads=num_threads)
+
+
+class FeatureExtractor:
+    """
+    Extracts patch features from a stream of tiles in batches
+
+    Tiles are read and batched on a background thread (PyVips releases the GIL) while
+    the encoder runs on the previous batch, so decoding and inference overlap. At most
+    prefetch_batches batches are waiting at any time, which bounds memory use.
+    """
+
+    def __init__(
+        self,
+        *,
+        encoder,
+        batch_size=64,
+        prefetch_batches=2,
+        mean=IMAGENET_MEAN,
+        std=IMAGENET_STD,
+    ):
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+        self.mean = mean
+        self.std = std
+
+    def extract(self, tiles, *, output_path, attributes=None):
+        """
+        Encodes (level, x, y, tile) tuples, as yielded by iter_image_tiles, and
+        writes their features and coordinates to a FeatureWriter at output_path
+
+        Returns the number of encoded tiles.
+        """
+        mean = torch.tensor(self.mean).view(1, 3, 1, 1)
+        std = torch.tensor(self.std).view(1, 3, 1, 1)
+
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._read_batches,
+            kwargs=dict(tiles=tiles, batches=batches, stop=stop),
+            name="FeatureExtractionReader",
+            daemon=True,
+        )
+        reader.start()
+
+        count = 0
+        try:
+            with FeatureWriter(output_path, attributes=attributes) as writer:
+                with torch.inference_mode():
+                    while (item := batches.get()) is not None:
+                        if isinstance(item, BaseException):
+                            raise item
+                        coordinates, pixels = item
+                        batch = torch.from_numpy(pixels).permute(0, 3, 1, 2)
+                        batch = (batch.float().div_(255) - mean).div_(std)
+                        features = self.encoder(batch).reshape(len(pixels), -1)
+                        writer.append(coordinates, features.numpy())
+                        count += len(pixels)
+        finally:
+            stop.set()
+            reader.join()
+
+        return count
+
+    def _read_batches(self, *, tiles, batches, stop):
+        # Fills the queue with (coordinates, pixels) batches and a final None
+        try:
+            coordinates, pixels = [], []
+            for level, x, y, tile in tiles:
+                if stop.is_set():
+                    return
+                coordinates.append((level, x, y))
+                pixels.append(tile[:, :, :3])  # Drop alpha, e.g. from OpenSlide
+                if len(pixels) == self.batch_size:
+                    self._put(batches, (numpy.array(coordinates), numpy.stack(pixels)), stop)
+                    coordinates, pixels = [], []
+            if pixels:
+                self._put(batches, (numpy.array(coordinates), numpy.stack(pixels)), stop)
+        except BaseException as error:
+            self._put(batches, error, stop)
+        else:
+            self._put(batches, None, stop)
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # Blocks while the queue is full, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class FeatureWriter:
+    """
+    Writes patch features and their (level, x, y) coordinates to an HDF5 file
+
+    Features are stored as float16 in gzip compressed chunks of whole rows, and
+    can be appended batch by batch. Use iter_feature_chunks to read them back.
+    """
+
+    def __init__(self, path, *, attributes=None, chunk_rows=256):
+        self.path = Path(path)
+        self.attributes = attributes or {}
+        self.chunk_rows = chunk_rows
+        self._file = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it when done, so a partial store is never used
+        self._temporary_path = self.path.with_name(self.path.name + ".partial")
+        self._file = h5py.File(self._temporary_path, "w")
+        self._file.attrs.update(self.attributes)
+        self._file.create_dataset(
+            "coords",
+            shape=(0, 3),
+            maxshape=(None, 3),
+            dtype=numpy.int32,
+            chunks=(self.chunk_rows, 3),
+            compression="gzip",
+        )
+        return self
+
+    def append(self, coordinates, features):
+        if "features" not in self._file:
+            self._file.create_dataset(
+                "features",
+                shape=(0, features.shape[1]),
+                maxshape=(None, features.shape[1]),
+                dtype=numpy.float16,
+                chunks=(self.chunk_rows, features.shape[1]),
+                compression="gzip",
+                shuffle=True,
+            )
+        for name, values in (("coords", coordinates), ("features", features)):
+            dataset = self._file[name]
+            dataset.resize(len(dataset) + len(values), axis=0)
+            dataset[-len(values) :] = values
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._temporary_path, self.path)
+        else:
+            self._temporary_path.unlink(missing_ok=True)
+
+
+def iter_feature_chunks(path, *, chunk_rows=4096):
+    """
+    A generator that yields (coords, features) chunks from a feature store
+
+    Only one chunk is held in memory at a time. Features are returned as float32.
+    """
+    with h5py.File(path, "r") as f:
+        if "features" not in f:
+            return  # No tiles were encoded
+        coords, features = f["coords"], f["features"]
+        for start in range(0, len(features), chunk_rows):
+            yield (
+                coords[start : start + chunk_rows],
+                features[start : start + chunk_rows].astype(numpy.float32),
+            )
+
+
+def get_feature_cache_key(*, image_path, encoder_path, tile_index=None, **parameters):
+    """
+    Returns the key of a feature store in the FeatureCache
+
+    The key combines the digest of the slide file, the digest of the encoder file,
+    the tiles that are encoded (all, or those in tile_index) and any further tiling
+    parameters, such as tile_size and level.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(get_file_digest(image_path).encode())
+    key.update(get_file_digest(encoder_path).encode())
+    key.update(json.dumps(parameters, sort_keys=True).encode())
+    if tile_index is not None:
+        key.update(numpy.ascontiguousarray(tile_index).tobytes())
+    return key.hexdigest()
+
+
+class FeatureCache:
+    """
+    A persistent cache of feature stores on disk, see get_feature_cache_key
+
+    Feature stores are small compared to the slides they are extracted from, so
+    the cache is not evicted; remove the directory to clear it.
+    """
+
+    def __init__(self, *, directory):
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, key):
+        return self.directory / f"{key}.h5"
+
+    def get(self, key, *, output_path):
+        # Copies the cached feature store to output_path, returns False on a miss
+        path = self.get_path(key)
+        try:
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path, output_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, *, output_path):
+        # Copies a feature store into the cache, renaming so it never is partial
+        path = self.get_path(key)
+        temporary_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(output_path, temporary_path)
+        os.replace(temporary_path, path)
+
+
+@functools.cache
+def get_feature_cache():
+    """
+    Returns the feature cache used by feature extraction, or None if it is disabled
+
+    The cache is opt-in: set FEATURE_CACHE_DIRECTORY to enable it, e.g. to a
+    directory on a volume that persists between container runs.
+    """
+    directory = os.getenv("FEATURE_CACHE_DIRECTORY")
+    if not directory:
+        return None
+    return FeatureCache(directory=directory)
+
+
+def get_resample_cache_key(*, volume_path, volume, reference, **parameters):
+    """
+    Returns the key of a resampled volume in the VolumeCache
+
+    The key combines the digest of the volume file, the grid of the (possibly
+    cropped) volume, the grid it is resampled onto and further parameters, such
+    as the interpolator.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(get_file_digest(volume_path).encode())
+    key.update(repr(_get_grid(volume)).encode())
+    key.update(repr(_get_grid(reference)).encode())
+    key.update(json.dumps(parameters, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+class VolumeCache:
+    """
+    A persistent cache of volumes on disk, see get_resample_cache_key
+
+    Volumes are stored as uncompressed .mha, so a cached volume is memory-mapped
+    when it is loaded. The cache is not evicted; remove the directory to clear it.
+    """
+
+    def __init__(self, *, directory):
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, key):
+        return self.directory / f"{key}.mha"
+
+    def get(self, key):
+        # Returns the cached Volume, or None on a miss
+        try:
+            volume = load_mha_volume(self.get_path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return volume
+
+    def put(self, key, volume):
+        # Writes a volume into the cache, renaming so it never is partial
+        path = self.get_path(key)
+        temporary_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp.mha")
+        SimpleITK.WriteImage(_volume_to_image(volume), str(temporary_path))
+        os.replace(temporary_path, path)
+
+
+@functools.cache
+def get_resample_cache():
+    """
+    Returns the cache of resampled volumes, or None if it is disabled
+
+    The cache is opt-in: set RESAMPLE_CACHE_DIRECTORY to enable it, e.g. to a
+    directory on a volume that persists between container runs.
+    """
+    directory = os.getenv("RESAMPLE_CACHE_DIRECTORY")
+    if not directory:
+        return None
+    return VolumeCache(directory=directory)
+
+
+def load_gated_attention(path):
+    """
+    Loads the weights of a gated attention module (Ilse et al., 2018) from a .npz
+
+    The file holds V and U of shape (d, h) and w of shape (h,), and optionally the
+    biases b_V and b_U of shape (h,) and b_w. Returns a function that maps a (n, d)
+    feature chunk onto (n,) attention logits, for use in StreamingAttentionPooling.
+    """
+    with numpy.load(path) as weights:
+        V, U, w = weights["V"], weights["U"], weights["w"]
+        b_V = weights["b_V"] if "b_V" in weights else 0.0
+        b_U = weights["b_U"] if "b_U" in weights else 0.0
+        b_w = weights["b_w"] if "b_w" in weights else 0.0
+
+    def attention(features):
+        gate = 1.0 / (1.0 + numpy.exp(-(features @ U + b_U)))
+        return (numpy.tanh(features @ V + b_V) * gate) @ w + b_w
+
+    return attention
+
+
+@functools.cache
+def get_gated_attention(path):
+    """Returns the gated attention at path, loaded once per process with load_gated_attention"""
+    with timed_stage(f"model load {Path(path).name}"):
+        return load_gated_attention(path)
+
+
+class StreamingAttentionPooling:
+    """
+    Attention pooling of patch features that arrive in chunks, in a single pass
+
+    The pooled embedding is sum(softmax(a) * h) over all patches h with attention
+    logits a. Instead of holding all patches, a running maximum logit m, the sum of
+    exp(a - m) and the exp(a - m) weighted sum of features are kept, and rescaled
+    whenever m grows (log-sum-exp). Memory use is that of a single chunk, however
+    many patches or slides are pooled.
+    """
+
+    def __init__(self, *, attention):
+        self.attention = attention
+        self.count = 0
+        self._max_logit = -numpy.inf
+        self._weight_sum = 0.0
+        self._weighted_features = None
+
+    def update(self, features):
+        if not len(features):
+            return
+        features = numpy.asarray(features, dtype=numpy.float64)
+        logits = numpy.asarray(self.attention(features), dtype=numpy.float64).ravel()
+
+        max_logit = max(self._max_logit, logits.max())
+        rescale = numpy.exp(self._max_logit - max_logit)
+        weights = numpy.exp(logits - max_logit)
+
+        if self._weighted_features is None:
+            self._weighted_features = numpy.zeros(features.shape[1])
+        self._weighted_features = self._weighted_features * rescale + weights @ features
+        self._weight_sum = self._weight_sum * rescale + weights.sum()
+        self._max_logit = max_logit
+        self.count += len(features)
+
+    def result(self):
+        if self._weighted_features is None:
+            raise ValueError("No features were pooled")
+        return (self._weighted_features / self._weight_sum).astype(numpy.float32)
+
+
+def pool_feature_stores(paths, *, attention, chunk_rows=4096):
+    """
+    Pools the features of one or more feature stores into a single embedding
+
+    The stores are streamed chunk by chunk (see iter_feature_chunks), so only one
+    chunk of one store is in memory at a time.
+    """
+    pooling = StreamingAttentionPooling(attention=attention)
+    for path in paths:
+        for _, features in iter_feature_chunks(path, chunk_rows=chunk_rows):
+            pooling.update(features)
+    return pooling.result()
@@ -22,21 +22,309 @@ Happy programming!
 """
 
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, partial
+import argparse
 import json
-from glob import glob
+import multiprocessing
+import os
+import signal
+import socketserver
+import tempfile
+import traceback
 import random
-import pyvips
-import SimpleITK
-import numpy
+from helpers import (
+    FEATURE_MEMORY_SHARE,
+    STAGE_TIMINGS,
+    THUMBNAIL_MEMORY_SHARE,
+    FeatureExtractor,
+    InputManifest,
+    build_tissue_tile_index,
+    configure_resources,
+    get_encoder,
+    get_feature_batching,
+    get_feature_cache,
+    get_feature_cache_key,
+    get_file_digest,
+    get_memory_budget,
+    get_gated_attention,
+    get_mask_bounding_box,
+    get_resample_cache,
+    get_resample_cache_key,
+    get_thumbnail_max_size,
+    get_tile_cache,
+    iter_image_tiles,
+    lazy_import,
+    load_inputs_concurrently,
+    load_inputs_lazily,
+    load_mha_region,
+    load_mha_volume,
+    open_image_level,
+    pool_feature_stores,
+    prefetch_inputs,
+    record_startup_event,
+    report_startup_times,
+    resample_volume,
+    timed_stage,
+)
+
+# Heavy libraries are imported on first use, which keeps the cold start short
+numpy = lazy_import("numpy")
+pyvips = lazy_import("pyvips")
+torch = lazy_import("torch")
 
 INPUT_PATH = Path("/input")
 OUTPUT_PATH = Path("/output")
 RESOURCE_PATH = Path("resources")
+ENCODER_PATH = Path("/opt/ml/model/encoder.pt")
+FEATURES_PATH = Path("/tmp/features")
+ATTENTION_PATH = Path("/opt/ml/model/attention.npz")
+MRI_ENCODER_PATH = Path("/opt/ml/model/mri_encoder.pt")
+
+# MRI volumes are cropped to the prostate mask, grown by this many millimetres on every side
+MRI_ROI_MARGIN = 10.0
+
+# The MRI sequences, stacked as channels on the grid of T2 for the MRI encoder
+MRI_SEQUENCES = ("axial_t2_prostate_mri", "axial_adc_prostate_mri", "transverse_hbv_prostate_mri")
+
+# The inputs that are resampled onto the grid of T2: their socket folder and interpolator
+MRI_ON_T2_GRID = {
+    "axial_adc_prostate_mri": ("images/axial-adc-prostate-mri", "linear"),
+    "transverse_hbv_prostate_mri": ("images/transverse-hbv-prostate-mri", "linear"),
+    "prostate_tissue_mask_for_axial_t2_prostate_mri": (
+        "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+        "nearest",
+    ),
+}
+
+# The inputs the model uses; these are loaded concurrently before processing starts
+# Any other input is only loaded if and when a handler accesses it
+PREFETCH_INPUTS = (
+    "axial_adc_prostate_mri",
+    "axial_t2_prostate_mri",
+    "chimera_clinical_data_of_prostate_cancer_patients",
+    "prostate_tissue_mask_for_axial_t2_prostate_mri",
+    "prostatectomy_tissue_mask",
+    "prostatectomy_tissue_whole_slide_image",
+    "transverse_hbv_prostate_mri",
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs the algorithm on /input, on a directory of cases, or as a server"
+    )
+    parser.add_argument(
+        "--batch",
+        nargs=2,
+        type=Path,
+        metavar=("INPUT_DIR", "OUTPUT_DIR"),
+        help="process every case folder in INPUT_DIR (such as test/input) into OUTPUT_DIR",
+    )
+    parser.add_argument(
+        "--serve",
+        type=Path,
+        metavar="SOCKET",
+        help="keep the model loaded and run the cases sent over a Unix socket at SOCKET",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of cases processed in parallel in batch mode (default: BATCH_MAX_WORKERS or 1)",
+    )
+    args = parser.parse_args(argv)
+
+    # Size the thread pools to the container before any library starts its own
+    configure_resources()
+
+    if args.serve:
+        return serve(socket_path=args.serve)
+    if args.batch:
+        input_directory, output_directory = args.batch
+        return run_batch(
+            input_directory=input_directory,
+            output_directory=output_directory,
+            max_workers=args.workers,
+        )
+    return run()
+
+
+def run_case(*, input_path, output_path, features_path=None):
+    # Runs a single case as if its inputs were mounted at /input and its outputs at /output
+    global INPUT_PATH, OUTPUT_PATH, FEATURES_PATH
+    paths = INPUT_PATH, OUTPUT_PATH, FEATURES_PATH
+    INPUT_PATH = Path(input_path)
+    OUTPUT_PATH = Path(output_path)
+    FEATURES_PATH = Path(features_path or FEATURES_PATH)
+    OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
+    try:
+        return run()
+    finally:
+        INPUT_PATH, OUTPUT_PATH, FEATURES_PATH = paths
+
+
+def preload_model():
+    # Loads the model once, batch and server mode then reuse it for every case
+    if ENCODER_PATH.exists():
+        get_encoder(ENCODER_PATH)
+    if ATTENTION_PATH.exists():
+        get_gated_attention(ATTENTION_PATH)
+    if MRI_ENCODER_PATH.exists():
+        get_encoder(MRI_ENCODER_PATH)
+
+
+def get_batch_max_workers():
+    """
+    Returns the number of cases processed in parallel in batch mode
+
+    Each case holds its own slides in memory, so this defaults to one case at a time.
+    To change it, set BATCH_MAX_WORKERS
+    """
+    return int(os.getenv("BATCH_MAX_WORKERS") or 1)
+
+
+def run_batch(*, input_directory, output_directory, max_workers=None):
+    """
+    Run every case folder in input_directory, i.e. the test/input/interface_N layout, and write
+    the outputs of each case to the folder with the same name in output_directory
+    The model is loaded once up front; with more than one worker the cases run in forked
+    processes, which share the loaded model with this one
+    """
+    case_directories = sorted(
+        path for path in Path(input_directory).iterdir() if (path / "inputs.json").is_file()
+    )
+    max_workers = max_workers or get_batch_max_workers()
+    print(f"Batch mode: {len(case_directories)} cases in {input_directory}, {max_workers} workers")
+
+    preload_model()
+
+    # Cases that run side by side must not share feature stores
+    jobs = [
+        dict(
+            input_path=case_directory,
+            output_path=Path(output_directory) / case_directory.name,
+            features_path=FEATURES_PATH / case_directory.name,
+        )
+        for case_directory in case_directories
+    ]
+
+    if max_workers == 1:
+        results = list(map(_run_batch_job, jobs))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_batch_worker,
+            initargs=(max_workers,),
+        ) as executor:
+            results = list(executor.map(_run_batch_job, jobs))
+
+    failures = {name: error for name, error in results if error}
+    print(f"Batch mode: {len(jobs) - len(failures)} of {len(jobs)} cases succeeded")
+    for name, error in failures.items():
+        print(f"\t{name}: {error}")
+    return 1 if failures else 0
+
+
+def _init_batch_worker(max_workers):
+    # Split the CPUs between the workers, rather than every worker using all of them
+    threads = str(max(1, configure_resources().cpus // max_workers))
+    for variable in ("VIPS_CONCURRENCY", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS"):
+        os.environ[variable] = threads
+    # Split the memory budget likewise
+    if memory_budget := get_memory_budget():
+        os.environ["MEMORY_BUDGET_MB"] = str(memory_budget / max_workers / (1 << 20))
+    # Forked workers inherit the random state of the parent, so they would all draw the
+    # same random numbers; reseed them from the operating system instead
+    random.seed()
+    numpy.random.seed()
+    if ENCODER_PATH.exists() or MRI_ENCODER_PATH.exists():
+        torch.set_num_threads(int(threads))
+
+
+def _run_batch_job(job):
+    # A failing case is reported, it does not stop the rest of the batch
+    name = job["input_path"].name
+    try:
+        result = run_case(**job)
+    except Exception as e:
+        traceback.print_exc()
+        return name, repr(e)
+    return name, f"exit code {result}" if result else None
+
+
+def serve(*, socket_path):
+    """
+    Keep the algorithm resident and run the cases that are sent over a Unix socket at socket_path
+    A request is a line of JSON with the "input_path" of a case folder and optionally an
+    "output_path" (defaults to a new folder in /tmp); the response is a line of JSON with the
+    "status" and the contents of the JSON "outputs" the case wrote
+    """
+    socket_path = Path(socket_path)
+    socket_path.unlink(missing_ok=True)
+    preload_model()
+
+    # Stopping the container sends SIGTERM, shut down as on Ctrl+C so the socket is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with socketserver.UnixStreamServer(str(socket_path), CaseRequestHandler) as server:
+        print(f"Serving on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+    return 0
+
+
+class CaseRequestHandler(socketserver.StreamRequestHandler):
+    # Answers every line of JSON on a connection, one case at a time
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                response = handle_case_request(line)
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def handle_case_request(line):
+    # Runs the case of a request from serve, a failing case is answered with its error
+    try:
+        request = json.loads(line)
+        input_path = Path(request["input_path"])
+        output_path = Path(
+            request.get("output_path") or tempfile.mkdtemp(prefix=f"{input_path.name}-")
+        )
+        exit_code = run_case(
+            input_path=input_path,
+            output_path=output_path,
+            features_path=FEATURES_PATH / input_path.name,
+        )
+        outputs = {
+            path.name: load_json_file(location=path)
+            for path in sorted(output_path.glob("*.json"))
+        }
+    except Exception as e:
+        traceback.print_exc()
+        return {"status": "error", "error": repr(e)}
+
+    return {
+        "status": "ok" if exit_code == 0 else "failed",
+        "exit_code": exit_code,
+        "output_path": str(output_path),
+        "outputs": outputs,
+    }
 
 
 def run():
+    configure_resources()
+    STAGE_TIMINGS.reset()
+    _get_input_manifest.cache_clear()
+
     # The key is a tuple of the slugs of the input sockets
-    interface_key = get_interface_key()
+    with timed_stage("input discovery"):
+        interface_key = get_interface_key()
+    record_startup_event("inputs.json read")
 
     # Lookup the handler for this particular set of sockets (i.e. the interface)
     handler = {
@@ -222,36 +510,60 @@ def run():
         ): interf9_handler,
     }[interface_key]
 
-    # Call the handler
-    return handler()
+    # Call the handler, then report where the startup time and the time per stage went
+    try:
+        return handler()
+    finally:
+        report_startup_times()
+        write_stage_timings(interface_key=interface_key)
 
 
 def interf0_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 2)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -259,21 +571,21 @@ def interf0_handler():
     # Debug: Print information about loaded data
     print("=+=" * 10)
     print("Data Loading Summary:")
-    print(f"MRI T2 shape: {input_axial_t2_prostate_mri.shape}")
-    print(f"MRI ADC shape: {input_axial_adc_prostate_mri.shape}")
-    print(f"MRI HBV shape: {input_transverse_hbv_prostate_mri.shape}")
-    print(f"Pathology WSI type: {type(input_prostatectomy_tissue_whole_slide_image)}")
-    if hasattr(input_prostatectomy_tissue_whole_slide_image, 'width'):
-        print(f"Pathology WSI size: {input_prostatectomy_tissue_whole_slide_image.width}x{input_prostatectomy_tissue_whole_slide_image.height}")
+    print(f"MRI T2 shape: {inputs['axial_t2_prostate_mri'].array.shape}")
+    print(f"MRI ADC shape: {inputs['axial_adc_prostate_mri'].array.shape}")
+    print(f"MRI HBV shape: {inputs['transverse_hbv_prostate_mri'].array.shape}")
+    print(f"Pathology WSI type: {type(inputs['prostatectomy_tissue_whole_slide_image'].load())}")
+    if hasattr(inputs['prostatectomy_tissue_whole_slide_image'], 'width'):
+        print(f"Pathology WSI size: {inputs['prostatectomy_tissue_whole_slide_image'].width}x{inputs['prostatectomy_tissue_whole_slide_image'].height}")
     
     # Handle both PyVips images and numpy arrays
-    if hasattr(input_prostatectomy_tissue_mask, 'width'):
-        print(f"Tissue mask size: {input_prostatectomy_tissue_mask.width}x{input_prostatectomy_tissue_mask.height}")
+    if hasattr(inputs['prostatectomy_tissue_mask'], 'width'):
+        print(f"Tissue mask size: {inputs['prostatectomy_tissue_mask'].width}x{inputs['prostatectomy_tissue_mask'].height}")
     else:
-        print(f"Tissue mask shape: {input_prostatectomy_tissue_mask.shape}")
+        print(f"Tissue mask shape: {inputs['prostatectomy_tissue_mask'].shape}")
     
-    print(f"Prostate mask shape: {input_prostate_tissue_mask_for_axial_t2_prostate_mri.shape}")
-    print(f"Clinical data keys: {list(input_chimera_clinical_data_of_prostate_cancer_patients.keys()) if input_chimera_clinical_data_of_prostate_cancer_patients else 'None'}")
+    print(f"Prostate mask shape: {inputs['prostate_tissue_mask_for_axial_t2_prostate_mri'].array.shape}")
+    print(f"Clinical data keys: {list(inputs['chimera_clinical_data_of_prostate_cancer_patients'].keys()) if inputs['chimera_clinical_data_of_prostate_cancer_patients'] else 'None'}")
     print("=+=" * 10)
 
     # Some additional resources might be required, include these in one of two ways.
@@ -293,9 +605,26 @@ def interf0_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=1)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -308,40 +637,61 @@ def interf0_handler():
 
 
 def interf1_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 4)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -363,9 +713,26 @@ def interf1_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=2)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -378,49 +745,71 @@ def interf1_handler():
 
 
 def interf2_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    # Use thumbnail loading for large WSI to avoid memory issues  
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 6)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -442,9 +831,26 @@ def interf2_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=3)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -457,54 +863,81 @@ def interf2_handler():
 
 
 def interf3_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 8)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -526,9 +959,26 @@ def interf3_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=4)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -541,62 +991,91 @@ def interf3_handler():
 
 
 def interf4_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 10)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -618,9 +1097,26 @@ def interf4_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=5)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -633,70 +1129,101 @@ def interf4_handler():
 
 
 def interf5_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 12)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -718,9 +1245,26 @@ def interf5_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=6)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -733,78 +1277,111 @@ def interf5_handler():
 
 
 def interf6_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 14)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -826,9 +1403,26 @@ def interf6_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=7)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -841,86 +1435,121 @@ def interf6_handler():
 
 
 def interf7_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 16)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -942,9 +1571,26 @@ def interf7_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=8)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -957,94 +1603,131 @@ def interf7_handler():
 
 
 def interf8_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_8 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-8",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_8_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-8",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 18)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_8": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-8",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_8_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-8",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -1066,9 +1749,26 @@ def interf8_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=9)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -1081,102 +1781,141 @@ def interf8_handler():
 
 
 def interf9_handler():
-    # Read the input
-    input_transverse_hbv_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
-    )
-    input_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-t2-prostate-mri",
-    )
-    input_axial_adc_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/axial-adc-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_mask = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask",
-        max_size=1024,
-    )
-    input_chimera_clinical_data_of_prostate_cancer_patients = load_json_file(
-        location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_8 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-8",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_9 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-wsi-z-9",
-        max_size=1024,
-    )
-    input_prostate_tissue_mask_for_axial_t2_prostate_mri = load_image_file_as_array(
-        location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
-    )
-    input_prostatectomy_tissue_whole_slide_image_1_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_2_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_3_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_4_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_5_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_6_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_7_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_8_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-8",
-        max_size=1024,
-    )
-    input_prostatectomy_tissue_whole_slide_image_9_2 = load_image_file_as_thumbnail(
-        location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-9",
-        max_size=1024,
-    )
+    # The thumbnails split the memory budget for thumbnails, so they are more detailed
+    # in containers with more memory
+    thumbnail_budget = get_memory_budget(share=THUMBNAIL_MEMORY_SHARE / 20)
+
+    # Read the input, each socket is only loaded on first access
+    inputs = load_inputs_lazily(
+        loaders={
+            "transverse_hbv_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/transverse-hbv-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "axial_adc_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/axial-adc-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_mask": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask",
+                memory_budget=thumbnail_budget,
+            ),
+            "chimera_clinical_data_of_prostate_cancer_patients": partial(
+                load_json_file,
+                location=INPUT_PATH / "chimera-clinical-data-of-prostate-cancer-patients.json",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-7",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_8": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-8",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_9": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-wsi-z-9",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostate_tissue_mask_for_axial_t2_prostate_mri": partial(
+                load_image_file_as_region,
+                location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+                mask_location=INPUT_PATH / "images/prostate-tissue-mask-for-axial-t2-prostate-mri",
+            ),
+            "prostatectomy_tissue_whole_slide_image_1_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-1",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_2_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-2",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_3_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-3",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_4_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-4",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_5_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-5",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_6_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-6",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_7_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-7",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_8_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-8",
+                memory_budget=thumbnail_budget,
+            ),
+            "prostatectomy_tissue_whole_slide_image_9_2": partial(
+                load_image_file_as_thumbnail,
+                location=INPUT_PATH / "images/prostatectomy-tissue-mask-wsi-9",
+                memory_budget=thumbnail_budget,
+            ),
+        }
+    )
+    # The inputs the model uses are loaded up front, concurrently
+    prefetch_inputs(inputs, names=PREFETCH_INPUTS)
 
     # Process the inputs: any way you'd like
     _show_torch_cuda_info()
@@ -1198,9 +1937,26 @@ def interf9_handler():
     except FileNotFoundError:
         print("Model resource file not found - this is expected in test environment")
 
-    # For now, let us make bogus predictions
-    # Generate random float between 0 and 80 with one decimal place
-    output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
+    # Everything the model does is timed as the predict stage
+    with timed_stage("predict"):
+        # Pool the patch features of all prostatectomy slides into a patient-level embedding,
+        # if a patch encoder and attention weights are provided. A model head would predict
+        # from the returned embedding, the bogus prediction below does not use it
+        if ENCODER_PATH.exists() and ATTENTION_PATH.exists():
+            extract_prostatectomy_embedding(slide_count=10)
+        else:
+            print("Patch encoder or attention weights not found - skipping patient embedding")
+
+        # Encode T2, ADC and HBV on the grid of T2 into an MRI embedding, if an MRI encoder
+        # is provided; like the patient embedding, the bogus prediction below does not use it
+        if MRI_ENCODER_PATH.exists():
+            extract_mri_embedding(inputs)
+        else:
+            print("MRI encoder not found - skipping MRI embedding")
+
+        # For now, let us make bogus predictions
+        # Generate random float between 0 and 80 with one decimal place
+        output_time_to_biochemical_recurrence_for_prostate_cancer = round(random.uniform(0, 80), 1)
 
     # Save your output
     write_json_file(
@@ -1214,14 +1970,24 @@ def interf9_handler():
 
 def get_interface_key():
     # The inputs.json is a system generated file that contains information about
-    # the inputs that interface with the algorithm
-    inputs = load_json_file(
-        location=INPUT_PATH / "inputs.json",
-    )
-    socket_slugs = [sv["interface"]["slug"] for sv in inputs]
+    # the inputs that interface with the algorithm, it is read into the input manifest
+    socket_slugs = get_input_manifest().slugs
     return tuple(sorted(socket_slugs))
 
 
+def get_input_manifest():
+    # The files of all input sockets, found once per run and shared by all loaders
+    return _get_input_manifest(INPUT_PATH)
+
+
+@cache
+def _get_input_manifest(input_path):
+    if not (input_path / "inputs.json").exists():
+        # A loader used on its own, outside of a run
+        return InputManifest(input_path)
+    return InputManifest.from_inputs_json(input_path)
+
+
 def load_json_file(*, location):
     # Reads a json file
     with open(location, "r") as f:
@@ -1230,38 +1996,35 @@ def load_json_file(*, location):
 
 def write_json_file(*, location, content):
     # Writes a json file
-    with open(location, "w") as f:
+    with timed_stage(f"write {Path(location).name}"), open(location, "w") as f:
         f.write(json.dumps(content, indent=4))
 
 
+def write_stage_timings(*, interface_key):
+    # Timings go to stderr, or to timings.json next to the outputs if WRITE_TIMINGS_JSON is set
+    path = OUTPUT_PATH / "timings.json" if os.getenv("WRITE_TIMINGS_JSON") else None
+    STAGE_TIMINGS.write(path, interface=list(interface_key))
+
+
+def get_image_file_path(*, location):
+    # Finds the compatible image file of a socket directory in the input manifest
+    return str(get_input_manifest().get_image_file_path(location))
+
+
 def load_image_file_as_array(*, location):
     """
     Load image files using appropriate library based on file type:
     - PyVips for pathology images: .tif, .tiff, .mrxs, .svs, .ndpi
     - SimpleITK for radiology images: .mha
     """
-    # Find all compatible files
-    input_files = (
-        glob(str(location / "*.tif"))
-        + glob(str(location / "*.tiff"))
-        + glob(str(location / "*.mha"))
-        + glob(str(location / "*.mrxs"))
-        + glob(str(location / "*.svs"))
-        + glob(str(location / "*.ndpi"))
-    )
-    
-    if not input_files:
-        raise FileNotFoundError(f"No compatible image files found in {location}")
-    
-    file_path = input_files[0]
+    file_path = get_image_file_path(location=location)
     file_extension = Path(file_path).suffix.lower()
     
     if file_extension == '.mha':
         # Use SimpleITK for radiology images (.mha)
+        # The array is read-only: memory-mapped or a view on the SimpleITK buffer, not a copy
         print(f"Loading radiology image using SimpleITK: {file_path}")
-        image = SimpleITK.ReadImage(file_path)
-        array = SimpleITK.GetArrayFromImage(image)
-        return array
+        return load_mha_volume(file_path).array
     
     else:
         # Use PyVips for pathology images (.tif, .tiff, .mrxs, .svs, .ndpi)
@@ -1274,7 +2037,7 @@ def load_image_file_as_array(*, location):
         
         # Convert to numpy array
         # Note: This will load the entire image into memory
-        # For production use, consider processing tiles instead
+        # For full resolution whole slide images, use load_image_file_as_tiles instead
         memory_image = image.write_to_memory()
         array = numpy.frombuffer(memory_image, dtype=numpy.uint8)
         
@@ -1293,42 +2056,301 @@ def load_image_file_as_array(*, location):
         return array
 
 
-def load_image_file_as_thumbnail(*, location, max_size=1024):
+def load_image_file_as_volume(*, location):
+    """
+    Load a radiology image (.mha) without copying its voxels
+    Returns a Volume with the (read-only) array and its spacing, origin and direction
+    Uncompressed files are memory-mapped, others are a view on the SimpleITK buffer
+    """
+    file_path = get_image_file_path(location=location)
+    print(f"Loading radiology image as volume: {file_path}")
+    return load_mha_volume(file_path)
+
+
+def load_image_file_as_region(*, location, mask_location, margin=MRI_ROI_MARGIN):
     """
+    Load only the part of a radiology image (.mha) around the prostate
+    The box around the mask (grown by margin millimetres) is mapped through physical space,
+    so the volume does not need to be on the grid of the mask
+    Returns a cropped Volume, its origin is moved to the first voxel of the region
+    """
+    file_path = get_image_file_path(location=location)
+    mask = load_mha_volume(get_image_file_path(location=mask_location))
+    bounding_box = get_mask_bounding_box(mask, margin=margin)
+    print(f"Loading radiology image region using SimpleITK: {file_path}")
+    return load_mha_region(file_path, bounding_box=bounding_box)
+
+
+def load_image_file_as_thumbnail(*, location, max_size=None, memory_budget=None):
+    """
+    Load image as a thumbnail for memory-efficient processing of WSIs
+    This is recommended for actual whole slide images
     Returns the PyVips image object directly for memory efficiency
+    Without a max_size, the thumbnail is as large as memory_budget bytes allow (see get_thumbnail_max_size)
     """
-    input_files = (
-        glob(str(location / "*.tif"))
-        + glob(str(location / "*.tiff"))
-        + glob(str(location / "*.mha"))
-        + glob(str(location / "*.mrxs"))
-        + glob(str(location / "*.svs"))
-        + glob(str(location / "*.ndpi"))
-    )
-    
-    if not input_files:
-        raise FileNotFoundError(f"No compatible image files found in {location}")
-    
-    file_path = input_files[0]
+    file_path = get_image_file_path(location=location)
+    if max_size is None:
+        max_size = get_thumbnail_max_size(memory_budget=memory_budget)
     print(f"Loading pathology image as thumbnail using PyVips: {file_path}")
     
-    # Load image with PyVips
+    # Open the image with PyVips, this only reads the header
     image = pyvips.Image.new_from_file(file_path)
     
     # Calculate downsampling factor to fit within max_size
     scale_factor = min(max_size / image.width, max_size / image.height)
     if scale_factor < 1.0:
         print(f"Downsampling image by factor {scale_factor:.3f} (from {image.width}x{image.height} to {int(image.width*scale_factor)}x{int(image.height*scale_factor)})")
-        image = image.resize(scale_factor)
+        # Shrink-on-load: PyVips reads from the nearest pyramid level (OpenSlide level or TIFF page)
+        # so only the pixels needed for the thumbnail are decoded, not the full resolution slide
+        image = pyvips.Image.thumbnail(file_path, max_size, height=max_size, size="down")
     else:
         print(f"Image size {image.width}x{image.height} is within max_size={max_size}, no downsampling needed")
     
+    # Render the thumbnail now, so the slide is decoded here (e.g. on a loading thread)
+    # and not later on first pixel access; the thumbnail itself is small
+    image = image.copy_memory()
+
     # Return the PyVips image object directly (much more memory efficient)
     return image
 
 
+def load_image_file_as_tiles(
+    *, location, tile_size=512, level=0, tile_index=None, tile_cache=None
+):
+    """
+    Stream a whole slide image as fixed-size tiles, without loading the full slide
+    Yields (level, x, y, tile) with x, y the top-left corner in level coordinates
+    Memory use is bounded by a single tile, regardless of the slide size
+    Pass a tile_index from load_tissue_tile_index to only read tiles with tissue
+    Decoded tiles are kept in the on-disk tile cache, if enabled (see get_tile_cache)
+    """
+    file_path = get_image_file_path(location=location)
+    print(f"Streaming pathology image tiles of {tile_size}x{tile_size} at level {level} using PyVips: {file_path}")
+
+    tile_cache = tile_cache or get_tile_cache()
+    digest = get_file_digest(file_path) if tile_cache is not None else None
+
+    image = open_image_level(file_path, level=level)
+    yield from iter_image_tiles(
+        image,
+        tile_size=tile_size,
+        level=level,
+        tile_index=tile_index,
+        tile_cache=tile_cache,
+        digest=digest,
+    )
+
+    if tile_cache is not None:
+        print(f"Tile cache: {tile_cache.hits} hits, {tile_cache.misses} misses")
+
+
+def load_tissue_tile_index(
+    *, location, mask_location, tile_size=512, level=0, min_tissue=0.1
+):
+    """
+    Build the index of tiles that contain tissue, using the tissue mask at a low resolution
+    Returns a NumPy structured array with level, x, y and tissue (fraction) per tile
+    """
+    file_path = get_image_file_path(location=location)
+    mask_file_path = get_image_file_path(location=mask_location)
+    print(f"Building tissue tile index using PyVips: {file_path} with mask {mask_file_path}")
+
+    tile_index = build_tissue_tile_index(
+        image_path=file_path,
+        mask_path=mask_file_path,
+        tile_size=tile_size,
+        level=level,
+        min_tissue=min_tissue,
+    )
+
+    image = open_image_level(file_path, level=level)
+    total = -(-image.width // tile_size) * -(-image.height // tile_size)
+    print(f"Tissue tile index: {len(tile_index)} of {total} tiles contain at least {min_tissue:.0%} tissue")
+    return tile_index
+
+
+def extract_image_file_features(
+    *,
+    location,
+    output_path,
+    tile_index=None,
+    tile_size=224,
+    level=0,
+    encoder=None,
+    encoder_path=None,
+    batch_size=None,
+    prefetch_batches=None,
+    memory_budget=None,
+    num_threads=None,
+    feature_cache=None,
+):
+    """
+    Encode the tiles of a whole slide image with the patch encoder from the model directory
+    Writes float16 features and (level, x, y) coordinates to an HDF5 feature store at output_path
+    Pass a tile_index from load_tissue_tile_index to only encode tiles with tissue
+    Pass an encoder from get_encoder (loaded from encoder_path, defaults to ENCODER_PATH) to reuse it across slides
+    Features of unchanged slides are taken from the feature cache, if enabled (see get_feature_cache)
+    Unless given, batch_size and prefetch_batches follow from memory_budget bytes (see get_feature_batching),
+    which defaults to the share of the memory budget for feature extraction
+    """
+    file_path = get_image_file_path(location=location)
+    encoder_path = encoder_path or ENCODER_PATH
+
+    feature_cache = feature_cache or get_feature_cache()
+    if feature_cache is not None:
+        key = get_feature_cache_key(
+            image_path=file_path,
+            encoder_path=encoder_path,
+            tile_index=tile_index,
+            tile_size=tile_size,
+            level=level,
+        )
+        if feature_cache.get(key, output_path=output_path):
+            print(f"Feature cache hit for {file_path}: {key}")
+            return output_path
+        print(f"Feature cache miss for {file_path}: {key}")
+
+    if encoder is None:
+        encoder = get_encoder(encoder_path, num_threads=num_threads)
+
+    tiles = load_image_file_as_tiles(
+        location=location, tile_size=tile_size, level=level, tile_index=tile_index
+    )
+    if memory_budget is None:
+        memory_budget = get_memory_budget(share=FEATURE_MEMORY_SHARE)
+    default_batch_size, default_prefetch_batches = get_feature_batching(
+        tile_size=tile_size, memory_budget=memory_budget
+    )
+    extractor = FeatureExtractor(
+        encoder=encoder,
+        batch_size=batch_size or default_batch_size,
+        prefetch_batches=prefetch_batches or default_prefetch_batches,
+    )
+    print(f"Encoding batches of {extractor.batch_size} tiles, prefetching {extractor.prefetch_batches} batches")
+    with timed_stage(f"extract features {Path(location).name}"):
+        count = extractor.extract(
+            tiles,
+            output_path=output_path,
+            attributes=dict(tile_size=tile_size, level=level),
+        )
+    print(f"Extracted features of {count} tiles to {output_path}")
+
+    if feature_cache is not None:
+        feature_cache.put(key, output_path=output_path)
+        print(f"Feature cache: {feature_cache.hits} hits, {feature_cache.misses} misses")
+
+    return output_path
+
+
+def resample_mri_onto_t2(inputs):
+    """
+    Resample ADC and HBV (linear) and the prostate mask (nearest neighbour) onto the grid of T2
+    The sequences are resampled concurrently, and taken from the resample cache if it is
+    enabled (see get_resample_cache), so that a case is resampled only once
+    Returns the Volumes on the T2 grid by input name, T2 itself included
+    """
+    reference = inputs["axial_t2_prostate_mri"].load()
+    cache = get_resample_cache()
+
+    def resample(name):
+        relative_path, interpolator = MRI_ON_T2_GRID[name]
+        volume = inputs[name].load()
+        if cache is None:
+            return resample_volume(volume, reference=reference, interpolator=interpolator)
+
+        key = get_resample_cache_key(
+            volume_path=get_image_file_path(location=INPUT_PATH / relative_path),
+            volume=volume,
+            reference=reference,
+            interpolator=interpolator,
+        )
+        resampled = cache.get(key)
+        if resampled is None:
+            resampled = resample_volume(volume, reference=reference, interpolator=interpolator)
+            cache.put(key, resampled)
+        return resampled
+
+    with timed_stage("resample mri"):
+        resampled = load_inputs_concurrently(
+            loaders={name: partial(resample, name) for name in MRI_ON_T2_GRID},
+            max_workers=len(MRI_ON_T2_GRID),
+        )
+    if cache is not None:
+        print(f"Resample cache: {cache.hits} hits, {cache.misses} misses")
+    return {"axial_t2_prostate_mri": reference, **resampled}
+
+
+def get_prostatectomy_slide_locations(*, slide_count):
+    # The (slide, tissue mask) socket locations of the prostatectomy slides of a case
+    locations = [
+        (
+            INPUT_PATH / "images/prostatectomy-wsi",
+            INPUT_PATH / "images/prostatectomy-tissue-mask",
+        )
+    ]
+    for n in range(1, slide_count):
+        locations.append(
+            (
+                INPUT_PATH / f"images/prostatectomy-wsi-z-{n}",
+                INPUT_PATH / f"images/prostatectomy-tissue-mask-wsi-{n}",
+            )
+        )
+    return locations
+
+
+def extract_prostatectomy_embedding(*, slide_count, tile_size=224):
+    """
+    Pool the patch features of all prostatectomy slides of a case into a patient-level embedding
+    Features are extracted per slide to FEATURES_PATH and then streamed chunk by chunk through
+    attention pooling, so memory use is bounded by a single chunk instead of all slides
+    """
+    encoder = get_encoder(ENCODER_PATH)
+    attention = get_gated_attention(ATTENTION_PATH)
+
+    feature_paths = []
+    for location, mask_location in get_prostatectomy_slide_locations(slide_count=slide_count):
+        tile_index = load_tissue_tile_index(
+            location=location, mask_location=mask_location, tile_size=tile_size
+        )
+        feature_paths.append(
+            extract_image_file_features(
+                location=location,
+                output_path=FEATURES_PATH / f"{location.name}.h5",
+                tile_index=tile_index,
+                tile_size=tile_size,
+                encoder=encoder,
+            )
+        )
+
+    embedding = pool_feature_stores(feature_paths, attention=attention)
+    print(f"Pooled a patient embedding of size {len(embedding)} from {len(feature_paths)} slides")
+    return embedding
+
+
+def extract_mri_embedding(inputs):
+    """
+    Encode the MRI sequences of a case into an embedding with the MRI encoder
+    ADC and HBV are resampled onto the grid of T2 (see resample_mri_onto_t2) and stacked with T2
+    as channels (MRI_SEQUENCES), with the voxels outside the prostate mask set to zero
+    """
+    encoder = get_encoder(MRI_ENCODER_PATH)
+    mri = resample_mri_onto_t2(inputs)
+
+    mask = numpy.asarray(mri["prostate_tissue_mask_for_axial_t2_prostate_mri"].array) > 0
+    channels = numpy.stack(
+        [numpy.where(mask, numpy.asarray(mri[name].array, dtype=numpy.float32), 0) for name in MRI_SEQUENCES]
+    )
+    with torch.inference_mode():
+        embedding = encoder(torch.from_numpy(channels)[None]).reshape(-1).numpy()
+    print(f"Encoded an MRI embedding of size {len(embedding)} from {channels.shape} voxels")
+    return embedding
+
+
 def _show_torch_cuda_info():
-    import torch
+    if not ENCODER_PATH.exists():
+        # Importing torch takes seconds, only do so when there is a model that needs it
+        print("No encoder in the model directory, skipping Torch CUDA information")
+        return
 
     print("=+=" * 10)
     print("Collecting Torch CUDA information")
@@ -1341,4 +2363,4 @@ def _show_torch_cuda_info():
 
 
 if __name__ == "__main__":
-    raise SystemExit(run())
+    raise SystemExit(main())
@@ -35,9 +35,13 @@ import random
 from statistics import mean
 from pathlib import Path
 from pprint import pformat, pprint
-from helpers import run_prediction_processing, tree
-import pandas as pd
-from sksurv.metrics import concordance_index_censored
+from helpers import (
+    concordance_index_censored,
+    join_ground_truth,
+    load_ground_truth_index,
+    run_prediction_processing,
+    tree,
+)
 import numpy as np
 
 INPUT_DIRECTORY = Path("/input")
@@ -53,6 +57,9 @@ def main():
 
     predictions = read_predictions()
 
+    # Read the ground truth first, so a broken ground truth fails before any job runs
+    ground_truth = load_ground_truth_index(GROUND_TRUTH_DIRECTORY)
+
     print("predictions", predictions)
 
     # We now process each algorithm job for this submission
@@ -60,9 +67,16 @@ def main():
     # We work that out from predictions.json
 
     # Use concurrent workers to process the predictions more efficiently
-    metrics["results"] = run_prediction_processing(fn=process, predictions=predictions)
-
-    result_df = pd.DataFrame(metrics["results"])
+    # The jobs only gather the predictions, which are then joined to the ground truth at once
+    result_df = join_ground_truth(
+        run_prediction_processing(fn=process, predictions=predictions),
+        ground_truth=ground_truth,
+        columns={"case_id_gt_time": "time_to_follow_up_or_bcr", "case_id_gt_event": "event"},
+        on="ground_truth_case_id",
+    )
+    # The ground truth case_id is only needed for the join, the results keep their schema
+    result_df = result_df.drop(columns="ground_truth_case_id")
+    metrics["results"] = result_df.to_dict("records")
 
    
     print("result_df", result_df)
@@ -383,7 +397,6 @@ def process_interf0(
         slug="prostate-tissue-mask-for-axial-dwi-prostate-mri",
     )
 
-    # Fourthly, load your ground truth
     # Thirdly, retrieve the input image name to match it with an image in your ground truth
     image_name_prostatectomy_tissue_whole_slide_image = get_image_name(
             values=job["inputs"],
@@ -392,35 +405,10 @@ def process_interf0(
 
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY, dtype={'case_id': str})
-
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]==image_name_prostatectomy_tissue_whole_slide_image[:-6]]
-
-    print('gt_image_name_df',gt_image_name_df)
-
- 
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-6],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -495,37 +483,12 @@ def process_interf1(
         slug="prostatectomy-tissue-whole-slide-image-1-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -608,37 +571,12 @@ def process_interf2(
         slug="prostatectomy-tissue-whole-slide-image-2-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -729,37 +667,12 @@ def process_interf3(
         slug="prostatectomy-tissue-whole-slide-image-3-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -859,37 +772,12 @@ def process_interf4(
         slug="prostatectomy-tissue-whole-slide-image-4-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -996,37 +884,12 @@ def process_interf5(
         slug="prostatectomy-tissue-whole-slide-image-5-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -1141,37 +1004,12 @@ def process_interf6(
         slug="prostatectomy-tissue-whole-slide-image-6-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -1295,39 +1133,14 @@ def process_interf7(
         slug="prostatectomy-tissue-whole-slide-image-7-2",
     )
 
-    # Fourthly, load your ground truth
     # Include your ground truth 
 
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
@@ -1461,37 +1274,12 @@ def process_interf8(
         slug="prostatectomy-tissue-whole-slide-image-8-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
  
@@ -1631,37 +1419,12 @@ def process_interf9(
         slug="prostatectomy-tissue-whole-slide-image-9-2",
     )
 
-    # Fourthly, load your ground truth
     print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-
-    
-
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY)
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]
-                                       ==image_name_prostatectomy_tissue_whole_slide_image[:-2]]
-
-    
-
-    gt_image_name_time = gt_image_name_df["time_to_follow_up_or_bcr"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
+        "ground_truth_case_id": image_name_prostatectomy_tissue_whole_slide_image[:-2],
         "case_id_prediction_years_to_recurrence": result_time_to_biochemical_recurrence_for_prostate_cancer
     }
 
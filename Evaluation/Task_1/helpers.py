@@ -1,11 +1,13 @@
 import multiprocessing
 import os
 import sys
+import threading
 import traceback
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from multiprocessing import Manager, Process
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import psutil
 
 
@@ -29,34 +31,340 @@ def display_processing_report(succeeded, canceled, failed):
     print("")
 
 
-def get_max_workers():
+def get_cpu_count():
+    """
+    Returns the number of CPUs this container may use
+
+    That is the CPU quota of its cgroup (v2 cpu.max or v1 cfs quota) rounded up,
+    at most the number of CPUs the process may run on. multiprocessing.cpu_count()
+    reports all cores of the host instead.
+    """
+    cpu_count = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else multiprocessing.cpu_count()
+    )
+
+    cgroup = Path("/sys/fs/cgroup")
+    try:
+        quota, _, period = (cgroup / "cpu.max").read_text().strip().partition(" ")
+        if quota == "max":
+            return cpu_count
+    except OSError:
+        try:
+            quota = (cgroup / "cpu" / "cpu.cfs_quota_us").read_text().strip()
+            period = (cgroup / "cpu" / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return cpu_count
+        if int(quota) <= 0:
+            return cpu_count
+
+    return max(1, min(cpu_count, -(-int(quota) // int(period or 100000))))
+
+
+EXECUTION_MODES = ("thread", "process")
+
+
+def get_execution_mode():
+    """
+    Returns how predictions are processed: "thread" or "process"
+
+    Processing a prediction is mostly reading its output JSON, which is I/O
+    bound, so by default the predictions are processed by threads. Processes
+    suit predictions that need CPU-heavy work.
+
+    To change this, update the Dockerfile GRAND_CHALLENGE_EXECUTION_MODE
+    """
+    mode = os.getenv("GRAND_CHALLENGE_EXECUTION_MODE") or "thread"
+    if mode not in EXECUTION_MODES:
+        raise ValueError(
+            f"GRAND_CHALLENGE_EXECUTION_MODE must be one of {EXECUTION_MODES}, not {mode!r}"
+        )
+    return mode
+
+
+def get_max_workers(*, mode="process"):
     """
     Returns the maximum number of concurrent workers
 
     The optimal number of workers ultimately depends on how many resources
-    each process will call upon.
+    each process will call upon. By default there is one process per CPU of
+    the container (see get_cpu_count). Threads mostly wait for I/O, so there
+    are a few more of those.
 
     To limit this, update the Dockerfile GRAND_CHALLENGE_MAX_WORKERS
     """
 
     environ_cpu_limit = os.getenv("GRAND_CHALLENGE_MAX_WORKERS")
-    cpu_count = multiprocessing.cpu_count()
+    cpu_count = get_cpu_count()
+    max_workers = min(32, cpu_count + 4) if mode == "thread" else cpu_count
     return min(
         [
-            int(environ_cpu_limit or cpu_count),
-            cpu_count,
+            int(environ_cpu_limit or max_workers),
+            max_workers,
         ]
     )
 
 
-def run_prediction_processing(*, fn, predictions):
+def load_ground_truth_index(path, *, key="case_id"):
+    """
+    Reads a ground truth CSV once into a DataFrame indexed by case_id
+
+    The index is unique, so predictions can be joined to it in one vectorized
+    operation (see join_ground_truth) rather than looked up one by one.
+
+    Parameters
+    ----------
+    path : Path
+        The ground truth CSV.
+
+    key : str
+        The column that identifies a case, read as a string.
+
+    Returns
+    -------
+    The other columns of the ground truth, indexed by key
+    """
+    ground_truth_df = pd.read_csv(path, dtype={key: str})
+
+    duplicated = ground_truth_df[key][ground_truth_df[key].duplicated()]
+    if len(duplicated):
+        raise ValueError(
+            f"Duplicate {key}s in the ground truth {path}: {sorted(set(duplicated))}"
+        )
+
+    return ground_truth_df.set_index(key)
+
+
+def join_ground_truth(results, *, ground_truth, columns, on="case_id"):
+    """
+    Joins the results of all jobs to the ground truth in one go
+
+    This is the second phase of the evaluation: the jobs only gather the
+    predictions, which are then matched to the ground truth by case_id at once.
+    case_ids that are not in the ground truth are reported and stop the
+    evaluation. case_ids that have more than one prediction are reported, each
+    of their predictions is kept.
+
+    Parameters
+    ----------
+    results : list
+        The results of the jobs, dictionaries that hold the case_id in on.
+
+    ground_truth : DataFrame
+        The ground truth, indexed by case_id (see load_ground_truth_index).
+
+    columns : dict
+        The ground truth columns to add to the results, by the names to add
+        them under. They are inserted after on.
+
+    on : str
+        The column of the results to match to the ground truth index.
+
+    Returns
+    -------
+    A DataFrame of the results with the ground truth columns
+    """
+    if not results:
+        raise PredictionProcessingError("There are no predictions to join to the ground truth")
+
+    result_df = pd.DataFrame(results)
+    case_ids = result_df[on]
+
+    positions = ground_truth.index.get_indexer(case_ids)
+    unmatched = sorted(case_ids[positions < 0].unique())
+    duplicated = sorted(case_ids[case_ids.duplicated()].unique())
+
+    print(
+        f"Joined {len(result_df)} predictions to {len(ground_truth)} ground truth cases: "
+        f"{len(unmatched)} unmatched, {len(duplicated)} duplicate {on}s"
+    )
+    for case_id in duplicated:
+        print(f"More than one prediction: {case_id}", file=sys.stderr)
+    if unmatched:
+        for case_id in unmatched:
+            print(f"Not in the ground truth: {case_id}", file=sys.stderr)
+
+        raise PredictionProcessingError(f"{len(unmatched)} unmatched {on}s")
+
+    loc = result_df.columns.get_loc(on) + 1
+    for offset, (name, column) in enumerate(columns.items()):
+        result_df.insert(loc + offset, name, ground_truth[column].to_numpy()[positions])
+
+    return result_df
+
+
+def concordance_index_censored(event_indicator, event_time, estimate, tied_tol=1e-8):
+    """
+    Computes Harrell's concordance index for right-censored survival data
+
+    A replacement for sksurv.metrics.concordance_index_censored that takes
+    O(n log^2 n) rather than O(n^2) time: it has the same comparable pairs, tie
+    handling, errors and return value. A sample with an event is comparable to
+    the samples with a later time and to the censored samples at the same time.
+
+    Parameters
+    ----------
+    event_indicator : array of bool, shape = (n_samples,)
+        Whether each sample experienced an event (True) or was censored.
+
+    event_time : array of float, shape = (n_samples,)
+        The time of the event or of censoring.
+
+    estimate : array of float, shape = (n_samples,)
+        The risk scores, higher for samples with an earlier event.
+
+    tied_tol : float
+        Risk scores that differ by at most this much are tied.
+
+    Returns
+    -------
+    The concordance index, then the numbers of concordant, discordant and
+    risk-tied comparable pairs and of comparable pairs with tied times
     """
-    Processes predictions in a separate process.
+    event_indicator, event_time, estimate = _check_concordance_inputs(
+        event_indicator, event_time, estimate
+    )
+    n_samples = len(event_time)
+
+    # Order by time, events before censored samples at the same time: the samples
+    # comparable to an event then follow the events at its time
+    order = np.lexsort((~event_indicator, event_time))
+    event_time = event_time[order]
+    event_indicator = event_indicator[order]
+    estimate = estimate[order]
+
+    time_starts = np.flatnonzero(np.r_[True, event_time[1:] != event_time[:-1]])
+    time_sizes = np.diff(np.r_[time_starts, n_samples])
+    time_events = np.add.reduceat(event_indicator.astype(np.int64), time_starts)
+    tied_time = int(np.sum(time_events * (time_sizes - time_events)))
+
+    # An event alone at the last time has no comparable samples
+    if time_sizes[-1] == 1 and event_indicator[-1]:
+        event_indicator[-1] = False
+    if not event_indicator.any():
+        raise ValueError("Data has no comparable pairs, cannot estimate concordance index.")
+
+    events = np.flatnonzero(event_indicator)
+    time_index = np.searchsorted(time_starts, events, side="right") - 1
+    comparable_start = time_starts[time_index] + time_events[time_index]
+    comparable = n_samples - comparable_start
+
+    # Risk scores as ranks among the distinct scores, and for each event the ranks
+    # of the scores it is tied with
+    values = np.unique(estimate)
+    ranks = np.searchsorted(values, estimate)
+    lower = _get_tie_bound(values, estimate[events], ranks[events], tied_tol=tied_tol, side="lower")
+    upper = _get_tie_bound(values, estimate[events], ranks[events], tied_tol=tied_tol, side="upper")
+
+    # Counts of the comparable samples with a rank below lower and up to upper
+    bounds = np.concatenate([lower, upper + 1])
+    before = np.concatenate([comparable_start, comparable_start])
+    below = np.r_[0, np.cumsum(np.bincount(ranks))]
+    below = below[bounds] - _count_ranks_below(ranks, before=before, bounds=bounds, below=below)
+    lower_count, upper_count = below[: len(events)], below[len(events) :]
+
+    concordant = int(np.sum(lower_count))
+    tied_risk = int(np.sum(upper_count - lower_count))
+    discordant = int(np.sum(comparable - upper_count))
+    denominator = np.float64(np.sum(comparable))
+
+    cindex = (concordant + 0.5 * tied_risk) / denominator
+    return cindex, concordant, discordant, tied_risk, tied_time
+
+
+def _check_concordance_inputs(event_indicator, event_time, estimate):
+    # The checks of sksurv.metrics.concordance_index_censored
+    arrays = {
+        "event_indicator": np.asarray(event_indicator),
+        "event_time": np.asarray(event_time),
+        "estimate": np.asarray(estimate),
+    }
+    for name, array in arrays.items():
+        if array.ndim != 1:
+            raise ValueError(f"Expected 1D array for {name}, got {array.ndim}D array instead")
+    lengths = {len(array) for array in arrays.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Found input variables with inconsistent numbers of samples: {sorted(lengths)}")
+    for name, array in arrays.items():
+        if array.dtype.kind not in "fc":
+            continue
+        if np.isnan(array).any():
+            raise ValueError(f"Input {name} contains NaN.")
+        if np.isinf(array).any():
+            raise ValueError(f"Input {name} contains infinity or a value too large for {array.dtype!r}.")
+
+    event_indicator, event_time, estimate = arrays.values()
+    if not np.issubdtype(event_indicator.dtype, np.bool_):
+        raise ValueError(
+            f"only boolean arrays are supported as class labels for survival analysis, got {event_indicator.dtype}"
+        )
+    if len(event_time) < 2:
+        raise ValueError("Need a minimum of two samples")
+    if not event_indicator.any():
+        raise ValueError("All samples are censored")
+
+    return event_indicator, event_time, estimate
+
+
+def _get_tie_bound(values, estimate, ranks, *, tied_tol, side):
+    # The lowest (or highest) rank of the distinct values within tied_tol of each estimate,
+    # with the same comparison as sksurv, so rounding cannot move a tie across the bound
+    if side == "lower":
+        bound = np.minimum(np.searchsorted(values, estimate - tied_tol, side="left"), ranks)
+        step = -1
+    else:
+        bound = np.maximum(np.searchsorted(values, estimate + tied_tol, side="right") - 1, ranks)
+        step = 1
+
+    while True:
+        # Move outwards while the next value is tied, inwards while this one is not
+        outer = np.clip(bound + step, 0, len(values) - 1)
+        move_out = (outer != bound) & (np.absolute(values[outer] - estimate) <= tied_tol)
+        move_in = np.absolute(values[bound] - estimate) > tied_tol
+        if not (move_out.any() or move_in.any()):
+            return bound
+        bound = bound + step * move_out - step * move_in
+
+
+def _count_ranks_below(ranks, *, before, bounds, below):
+    # For each query q, the number of ranks[:before[q]] that are below bounds[q]
+    #
+    # This is binary indexed (Fenwick) tree counting, done offline for all queries: the
+    # ranks below a bound fall into at most one block of 2**level ranks per level, one
+    # for each set bit of the bound. Each level is one vectorized pass over the queries,
+    # after sorting the samples by block: O(n log n) per level, for log n levels.
+    # below[r] is the number of all ranks below r.
+    n_samples = len(ranks)
+    positions = np.arange(n_samples, dtype=np.int64)
+    ranks = ranks.astype(np.int64)
+    counts = np.zeros(len(bounds), dtype=np.int64)
+    for level in range(int(bounds.max()).bit_length()):
+        # Positions grouped by block, in order within a block
+        keys = np.sort((ranks >> level) * n_samples + positions)
+
+        query = np.flatnonzero((bounds >> level) & 1)
+        block = (bounds[query] >> level) - 1
+        needles = block * n_samples + before[query]
+        # Sorted needles make the binary searches cache friendly
+        order = np.argsort(needles)
+        counts[query[order]] += np.searchsorted(keys, needles[order])
+        counts[query] -= below[block << level]
+    return counts
+
+
+def run_prediction_processing(*, fn, predictions, chunk_size=None, mode=None):
+    """
+    Processes predictions in a pool of worker threads or processes.
 
     This takes child processes into account:
-    - if any child process is terminated, all prediction processing will abort
+    - if any prediction fails or a worker is terminated, all prediction processing will abort
     - after prediction processing is done, all child processes are terminated
 
+    Predictions are sent to the workers in chunks and the results of a chunk
+    come back with its future, so there is no inter-process traffic per
+    prediction.
+
     Note that the results are returned in completing order.
 
     Parameters
@@ -67,107 +375,126 @@ def run_prediction_processing(*, fn, predictions):
     predictions : list
         List of predictions.
 
+    chunk_size : int, optional
+        Predictions per chunk, by default about four chunks per worker.
+
+    mode : str, optional
+        "thread" or "process", by default from get_execution_mode.
+
     Returns
     -------
     A list of results
     """
-    print("Running prediction processing")
-    with Manager() as manager:
-        results = manager.dict()
-        errors = manager.dict()
-
-        pool_worker = _start_pool_worker(
-            fn=fn,
-            predictions=predictions,
-            max_workers=get_max_workers(),
-            results=results,
-            errors=errors,
-        )
-        try:
-            pool_worker.join()
-        finally:
-            pool_worker.terminate()
-
-        failed = set(errors.keys())
-        succeeded = set(results.keys())
-        canceled = set(p["pk"] for p in predictions) - (failed | succeeded)
-
-        display_processing_report(succeeded, canceled, failed)
-
-        print('failed:', len(failed),'succeeded:', len(succeeded), 'canceled:', len(canceled))
-
-        if errors:
-            for prediction_pk, tb_str in errors.items():
-                print(
-                    f"Error in prediction: {prediction_pk}\n{tb_str}",
-                    file=sys.stderr,
-                )
-
-            raise PredictionProcessingError()
-
-        return list(results.values())
-
-
-def _start_pool_worker(fn, predictions, max_workers, results, errors):
-    print("Started pooling worker")
-    process = Process(
-        target=_pool_worker,
-        name="PredictionProcessing",
-        kwargs=dict(
-            fn=fn,
-            predictions=predictions,
-            max_workers=max_workers,
-            results=results,
-            errors=errors,
-        ),
+    mode = mode or get_execution_mode()
+    max_workers = get_max_workers(mode=mode)
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(predictions) // (4 * max_workers)))
+    print(
+        f"Running prediction processing with {max_workers} {mode} workers ({get_cpu_count()} CPUs)"
+        f" in chunks of {chunk_size} predictions"
     )
-    process.start()
-
-    return process
 
+    if mode == "thread":
+        executor_class = ThreadPoolExecutor
+        # Threads cannot be terminated, they check this between predictions instead
+        stop = threading.Event()
+    else:
+        executor_class = ProcessPoolExecutor
+        stop = None
 
-def _pool_worker(*, fn, predictions, max_workers, results, errors):
-    caught_exception = False
-    print("In the pooling worker")
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        try:
-            # Submit the processing tasks of the predictions
-            futures = [
-                executor.submit(fn, prediction) for prediction in predictions
-            ]
-            future_to_predictions = {
-                future: item
-                for future, item in zip(futures, predictions, strict=True)
+    results = {}
+    errors = {}
+    try:
+        with executor_class(max_workers=max_workers) as executor:
+            future_to_chunk = {
+                executor.submit(_process_chunk, fn, chunk, stop=stop): chunk
+                for chunk in _split_into_chunks(predictions, chunk_size=chunk_size)
             }
+            for future in as_completed(future_to_chunk):
+                try:
+                    chunk_results, chunk_errors = future.result()
+                except Exception as error:
+                    # The worker itself failed, e.g. it was killed: so did its chunk
+                    tb_str = _format_exception(error)
+                    chunk_results = {}
+                    chunk_errors = {p["pk"]: tb_str for p in future_to_chunk[future]}
+
+                results.update(chunk_results)
+                errors.update(chunk_errors)
+
+                if errors:  # Hard stop
+                    for pending in future_to_chunk:
+                        pending.cancel()
+                    if stop is None:
+                        _terminate_workers(executor)
+                    else:
+                        stop.set()
+                    # Wait for the pool to reap its own workers, or its manager
+                    # thread blocks the interpreter exit
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    break
+    finally:
+        if stop is None:
+            # Be aggresive in cleaning up any left-over processes, now that
+            # the pool is shut down and no longer waits for its workers
+            _terminate_child_processes()
 
-            print("Submitted processing task of predictions")
+    failed = set(errors.keys())
+    succeeded = set(results.keys())
+    canceled = set(p["pk"] for p in predictions) - (failed | succeeded)
 
-            for future in as_completed(future_to_predictions):
-                prediction = future_to_predictions[future]
-                prediction_pk = prediction["pk"]
+    display_processing_report(succeeded, canceled, failed)
 
-                print("Getting predictions...",prediction_pk)
+    print('failed:', len(failed),'succeeded:', len(succeeded), 'canceled:', len(canceled))
 
-                error = future.exception()
+    if errors:
+        for prediction_pk, tb_str in errors.items():
+            print(
+                f"Error in prediction: {prediction_pk}\n{tb_str}",
+                file=sys.stderr,
+            )
 
-                if error:
-                    # Cannot pickle tracestacks, so format it here
-                    tb_exception = traceback.TracebackException.from_exception(
-                        error
-                    )
-                    errors[prediction_pk] = "".join(tb_exception.format())
+        raise PredictionProcessingError()
 
-                    if not caught_exception:  # Hard stop
-                        caught_exception = True
+    return list(results.values())
 
-                        executor.shutdown(wait=False, cancel_futures=True)
-                        _terminate_child_processes()
-                else:
-                    results[prediction_pk] = future.result()
 
-        finally:
-            # Be aggresive in cleaning up any left-over processes
-            _terminate_child_processes()
+def _split_into_chunks(predictions, *, chunk_size):
+    for start in range(0, len(predictions), chunk_size):
+        yield predictions[start : start + chunk_size]
+
+
+def _process_chunk(fn, chunk, *, stop=None):
+    # Runs in a worker: processes a chunk of predictions, up to the first failure
+    # (here or, for threads, in another chunk)
+    results = {}
+    errors = {}
+    for prediction in chunk:
+        if stop is not None and stop.is_set():
+            break
+        try:
+            results[prediction["pk"]] = fn(prediction)
+        except Exception as error:
+            errors[prediction["pk"]] = _format_exception(error)
+            break
+
+    return results, errors
+
+
+def _format_exception(error):
+    # Cannot pickle tracestacks, so format it here
+    return "".join(traceback.TracebackException.from_exception(error).format())
+
+
+def _terminate_workers(executor):
+    # Terminates only the workers of a process pool, which reaps them itself:
+    # reaping them here (e.g. with os.waitpid) would leave its manager thread
+    # waiting for them forever
+    for process in list((executor._processes or {}).values()):
+        try:
+            process.terminate()
+        except (OSError, ValueError):
+            pass  # Already gone
 
 
 def _terminate_child_processes():
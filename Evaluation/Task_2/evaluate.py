@@ -32,11 +32,10 @@ import json
 
 
 import random
-import pandas as pd
 from statistics import mean
 from pathlib import Path
 from pprint import pformat, pprint
-from helpers import run_prediction_processing, tree
+from helpers import join_ground_truth, load_ground_truth_index, run_prediction_processing, tree
 from sklearn.metrics import f1_score, roc_auc_score
 
 INPUT_DIRECTORY = Path("/input")
@@ -50,14 +49,21 @@ def main():
     metrics = {}
     predictions = read_predictions()
 
+    # Read the ground truth first, so a broken ground truth fails before any job runs
+    ground_truth = load_ground_truth_index(GROUND_TRUTH_DIRECTORY)
+
     # We now process each algorithm job for this submission
     # Note that the jobs are not in any specific order!
     # We work that out from predictions.json
 
     # Use concurrent workers to process the predictions more efficiently
-    metrics["results"] = run_prediction_processing(fn=process, predictions=predictions)
-
-    result_df = pd.DataFrame(metrics["results"])
+    # The jobs only gather the predictions, which are then joined to the ground truth at once
+    result_df = join_ground_truth(
+        run_prediction_processing(fn=process, predictions=predictions),
+        ground_truth=ground_truth,
+        columns={"case_id_gt": "target_class"},
+    )
+    metrics["results"] = result_df.to_dict("records")
     
     y_true = result_df["case_id_gt"].astype(int).values
     y_prob = result_df["case_id_pred"].astype(float).values
@@ -128,14 +134,8 @@ def process_interf0(
         slug="bladder-cancer-tissue-biopsy-whole-slide-image",
     )
 
-    ground_truth_df = pd.read_csv(GROUND_TRUTH_DIRECTORY)
-    gt_row = ground_truth_df[ground_truth_df["case_id"] == image_name_bladder_cancer_tissue_biopsy_whole_slide_image[:-4]]
-
-  
-
     return {
         "case_id": image_name_bladder_cancer_tissue_biopsy_whole_slide_image[:-4],
-        "case_id_gt": gt_row["target_class"].item(),
         "case_id_pred": result_brs_binary_classification
     }
 
@@ -1,11 +1,12 @@
 import multiprocessing
 import os
 import sys
+import threading
 import traceback
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from multiprocessing import Manager, Process
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import pandas as pd
 import psutil
 
 
@@ -29,34 +30,181 @@ def display_processing_report(succeeded, canceled, failed):
     print("")
 
 
-def get_max_workers():
+def get_cpu_count():
+    """
+    Returns the number of CPUs this container may use
+
+    That is the CPU quota of its cgroup (v2 cpu.max or v1 cfs quota) rounded up,
+    at most the number of CPUs the process may run on. multiprocessing.cpu_count()
+    reports all cores of the host instead.
+    """
+    cpu_count = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else multiprocessing.cpu_count()
+    )
+
+    cgroup = Path("/sys/fs/cgroup")
+    try:
+        quota, _, period = (cgroup / "cpu.max").read_text().strip().partition(" ")
+        if quota == "max":
+            return cpu_count
+    except OSError:
+        try:
+            quota = (cgroup / "cpu" / "cpu.cfs_quota_us").read_text().strip()
+            period = (cgroup / "cpu" / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return cpu_count
+        if int(quota) <= 0:
+            return cpu_count
+
+    return max(1, min(cpu_count, -(-int(quota) // int(period or 100000))))
+
+
+EXECUTION_MODES = ("thread", "process")
+
+
+def get_execution_mode():
+    """
+    Returns how predictions are processed: "thread" or "process"
+
+    Processing a prediction is mostly reading its output JSON, which is I/O
+    bound, so by default the predictions are processed by threads. Processes
+    suit predictions that need CPU-heavy work.
+
+    To change this, update the Dockerfile GRAND_CHALLENGE_EXECUTION_MODE
+    """
+    mode = os.getenv("GRAND_CHALLENGE_EXECUTION_MODE") or "thread"
+    if mode not in EXECUTION_MODES:
+        raise ValueError(
+            f"GRAND_CHALLENGE_EXECUTION_MODE must be one of {EXECUTION_MODES}, not {mode!r}"
+        )
+    return mode
+
+
+def get_max_workers(*, mode="process"):
     """
     Returns the maximum number of concurrent workers
 
     The optimal number of workers ultimately depends on how many resources
-    each process will call upon.
+    each process will call upon. By default there is one process per CPU of
+    the container (see get_cpu_count). Threads mostly wait for I/O, so there
+    are a few more of those.
 
     To limit this, update the Dockerfile GRAND_CHALLENGE_MAX_WORKERS
     """
 
     environ_cpu_limit = os.getenv("GRAND_CHALLENGE_MAX_WORKERS")
-    cpu_count = multiprocessing.cpu_count()
+    cpu_count = get_cpu_count()
+    max_workers = min(32, cpu_count + 4) if mode == "thread" else cpu_count
     return min(
         [
-            int(environ_cpu_limit or cpu_count),
-            cpu_count,
+            int(environ_cpu_limit or max_workers),
+            max_workers,
         ]
     )
 
 
-def run_prediction_processing(*, fn, predictions):
+def load_ground_truth_index(path, *, key="case_id"):
     """
-    Processes predictions in a separate process.
+    Reads a ground truth CSV once into a DataFrame indexed by case_id
+
+    The index is unique, so predictions can be joined to it in one vectorized
+    operation (see join_ground_truth) rather than looked up one by one.
+
+    Parameters
+    ----------
+    path : Path
+        The ground truth CSV.
+
+    key : str
+        The column that identifies a case, read as a string.
+
+    Returns
+    -------
+    The other columns of the ground truth, indexed by key
+    """
+    ground_truth_df = pd.read_csv(path, dtype={key: str})
+
+    duplicated = ground_truth_df[key][ground_truth_df[key].duplicated()]
+    if len(duplicated):
+        raise ValueError(
+            f"Duplicate {key}s in the ground truth {path}: {sorted(set(duplicated))}"
+        )
+
+    return ground_truth_df.set_index(key)
+
+
+def join_ground_truth(results, *, ground_truth, columns, on="case_id"):
+    """
+    Joins the results of all jobs to the ground truth in one go
+
+    This is the second phase of the evaluation: the jobs only gather the
+    predictions, which are then matched to the ground truth by case_id at once.
+    case_ids that are not in the ground truth are reported and stop the
+    evaluation. case_ids that have more than one prediction are reported, each
+    of their predictions is kept.
+
+    Parameters
+    ----------
+    results : list
+        The results of the jobs, dictionaries that hold the case_id in on.
+
+    ground_truth : DataFrame
+        The ground truth, indexed by case_id (see load_ground_truth_index).
+
+    columns : dict
+        The ground truth columns to add to the results, by the names to add
+        them under. They are inserted after on.
+
+    on : str
+        The column of the results to match to the ground truth index.
+
+    Returns
+    -------
+    A DataFrame of the results with the ground truth columns
+    """
+    if not results:
+        raise PredictionProcessingError("There are no predictions to join to the ground truth")
+
+    result_df = pd.DataFrame(results)
+    case_ids = result_df[on]
+
+    positions = ground_truth.index.get_indexer(case_ids)
+    unmatched = sorted(case_ids[positions < 0].unique())
+    duplicated = sorted(case_ids[case_ids.duplicated()].unique())
+
+    print(
+        f"Joined {len(result_df)} predictions to {len(ground_truth)} ground truth cases: "
+        f"{len(unmatched)} unmatched, {len(duplicated)} duplicate {on}s"
+    )
+    for case_id in duplicated:
+        print(f"More than one prediction: {case_id}", file=sys.stderr)
+    if unmatched:
+        for case_id in unmatched:
+            print(f"Not in the ground truth: {case_id}", file=sys.stderr)
+
+        raise PredictionProcessingError(f"{len(unmatched)} unmatched {on}s")
+
+    loc = result_df.columns.get_loc(on) + 1
+    for offset, (name, column) in enumerate(columns.items()):
+        result_df.insert(loc + offset, name, ground_truth[column].to_numpy()[positions])
+
+    return result_df
+
+
+def run_prediction_processing(*, fn, predictions, chunk_size=None, mode=None):
+    """
+    Processes predictions in a pool of worker threads or processes.
 
     This takes child processes into account:
-    - if any child process is terminated, all prediction processing will abort
+    - if any prediction fails or a worker is terminated, all prediction processing will abort
     - after prediction processing is done, all child processes are terminated
 
+    Predictions are sent to the workers in chunks and the results of a chunk
+    come back with its future, so there is no inter-process traffic per
+    prediction.
+
     Note that the results are returned in completing order.
 
     Parameters
@@ -67,98 +215,124 @@ def run_prediction_processing(*, fn, predictions):
     predictions : list
         List of predictions.
 
+    chunk_size : int, optional
+        Predictions per chunk, by default about four chunks per worker.
+
+    mode : str, optional
+        "thread" or "process", by default from get_execution_mode.
+
     Returns
     -------
     A list of results
     """
-    with Manager() as manager:
-        results = manager.dict()
-        errors = manager.dict()
-
-        pool_worker = _start_pool_worker(
-            fn=fn,
-            predictions=predictions,
-            max_workers=get_max_workers(),
-            results=results,
-            errors=errors,
-        )
-        try:
-            pool_worker.join()
-        finally:
-            pool_worker.terminate()
-
-        failed = set(errors.keys())
-        succeeded = set(results.keys())
-        canceled = set(p["pk"] for p in predictions) - (failed | succeeded)
-
-        display_processing_report(succeeded, canceled, failed)
-
-        if errors:
-            for prediction_pk, tb_str in errors.items():
-                print(
-                    f"Error in prediction: {prediction_pk}\n{tb_str}",
-                    file=sys.stderr,
-                )
-
-            raise PredictionProcessingError()
-
-        return list(results.values())
-
-
-def _start_pool_worker(fn, predictions, max_workers, results, errors):
-    process = Process(
-        target=_pool_worker,
-        name="PredictionProcessing",
-        kwargs=dict(
-            fn=fn,
-            predictions=predictions,
-            max_workers=max_workers,
-            results=results,
-            errors=errors,
-        ),
+    mode = mode or get_execution_mode()
+    max_workers = get_max_workers(mode=mode)
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(predictions) // (4 * max_workers)))
+    print(
+        f"Running prediction processing with {max_workers} {mode} workers ({get_cpu_count()} CPUs)"
+        f" in chunks of {chunk_size} predictions"
     )
-    process.start()
 
-    return process
+    if mode == "thread":
+        executor_class = ThreadPoolExecutor
+        # Threads cannot be terminated, they check this between predictions instead
+        stop = threading.Event()
+    else:
+        executor_class = ProcessPoolExecutor
+        stop = None
 
-
-def _pool_worker(*, fn, predictions, max_workers, results, errors):
-    caught_exception = False
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        try:
-            # Submit the processing tasks of the predictions
-            futures = [
-                executor.submit(fn, prediction) for prediction in predictions
-            ]
-            future_to_predictions = {
-                future: item
-                for future, item in zip(futures, predictions, strict=True)
+    results = {}
+    errors = {}
+    try:
+        with executor_class(max_workers=max_workers) as executor:
+            future_to_chunk = {
+                executor.submit(_process_chunk, fn, chunk, stop=stop): chunk
+                for chunk in _split_into_chunks(predictions, chunk_size=chunk_size)
             }
+            for future in as_completed(future_to_chunk):
+                try:
+                    chunk_results, chunk_errors = future.result()
+                except Exception as error:
+                    # The worker itself failed, e.g. it was killed: so did its chunk
+                    tb_str = _format_exception(error)
+                    chunk_results = {}
+                    chunk_errors = {p["pk"]: tb_str for p in future_to_chunk[future]}
+
+                results.update(chunk_results)
+                errors.update(chunk_errors)
+
+                if errors:  # Hard stop
+                    for pending in future_to_chunk:
+                        pending.cancel()
+                    if stop is None:
+                        _terminate_workers(executor)
+                    else:
+                        stop.set()
+                    # Wait for the pool to reap its own workers, or its manager
+                    # thread blocks the interpreter exit
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    break
+    finally:
+        if stop is None:
+            # Be aggresive in cleaning up any left-over processes, now that
+            # the pool is shut down and no longer waits for its workers
+            _terminate_child_processes()
 
-            for future in as_completed(future_to_predictions):
-                prediction = future_to_predictions[future]
-                prediction_pk = prediction["pk"]
+    failed = set(errors.keys())
+    succeeded = set(results.keys())
+    canceled = set(p["pk"] for p in predictions) - (failed | succeeded)
 
-                error = future.exception()
+    display_processing_report(succeeded, canceled, failed)
 
-                if error:
-                    # Cannot pickle tracestacks, so format it here
-                    tb_exception = traceback.TracebackException.from_exception(
-                        error
-                    )
-                    errors[prediction_pk] = "".join(tb_exception.format())
+    if errors:
+        for prediction_pk, tb_str in errors.items():
+            print(
+                f"Error in prediction: {prediction_pk}\n{tb_str}",
+                file=sys.stderr,
+            )
 
-                    if not caught_exception:  # Hard stop
-                        caught_exception = True
+        raise PredictionProcessingError()
 
-                        executor.shutdown(wait=False, cancel_futures=True)
-                        _terminate_child_processes()
-                else:
-                    results[prediction_pk] = future.result()
+    return list(results.values())
 
-        finally:
-            # Be aggresive in cleaning up any left-over processes
-            _terminate_child_processes()
+
+def _split_into_chunks(predictions, *, chunk_size):
+    for start in range(0, len(predictions), chunk_size):
+        yield predictions[start : start + chunk_size]
+
+
+def _process_chunk(fn, chunk, *, stop=None):
+    # Runs in a worker: processes a chunk of predictions, up to the first failure
+    # (here or, for threads, in another chunk)
+    results = {}
+    errors = {}
+    for prediction in chunk:
+        if stop is not None and stop.is_set():
+            break
+        try:
+            results[prediction["pk"]] = fn(prediction)
+        except Exception as error:
+            errors[prediction["pk"]] = _format_exception(error)
+            break
+
+    return results, errors
+
+
+def _format_exception(error):
+    # Cannot pickle tracestacks, so format it here
+    return "".join(traceback.TracebackException.from_exception(error).format())
+
+
+def _terminate_workers(executor):
+    # Terminates only the workers of a process pool, which reaps them itself:
+    # reaping them here (e.g. with os.waitpid) would leave its manager thread
+    # waiting for them forever
+    for process in list((executor._processes or {}).values()):
+        try:
+            process.terminate()
+        except (OSError, ValueError):
+            pass  # Already gone
 
 
 def _terminate_child_processes():
@@ -35,10 +35,14 @@ import random
 from statistics import mean
 from pathlib import Path
 from pprint import pformat, pprint
-from helpers import run_prediction_processing, tree
-from sksurv.metrics import concordance_index_censored
+from helpers import (
+    concordance_index_censored,
+    join_ground_truth,
+    load_ground_truth_index,
+    run_prediction_processing,
+    tree,
+)
 import numpy as np
-import pandas as pd
 INPUT_DIRECTORY = Path("/input")
 OUTPUT_DIRECTORY = Path("/output")
 GROUND_TRUTH_DIRECTORY = Path("/opt/ml/input/data/ground_truth/a_tarball_subdirectory/ground_truth.csv")
@@ -51,13 +55,20 @@ def main():
     metrics = {}
     predictions = read_predictions()
 
+    # Read the ground truth first, so a broken ground truth fails before any job runs
+    ground_truth = load_ground_truth_index(GROUND_TRUTH_DIRECTORY)
+
     # We now process each algorithm job for this submission
     # Note that the jobs are not in any specific order!
     # We work that out from predictions.json
 
-    metrics["results"] = run_prediction_processing(fn=process, predictions=predictions)
-
-    result_df = pd.DataFrame(metrics["results"])
+    # The jobs only gather the predictions, which are then joined to the ground truth at once
+    result_df = join_ground_truth(
+        run_prediction_processing(fn=process, predictions=predictions),
+        ground_truth=ground_truth,
+        columns={"case_id_gt_time": "time_to_HG_recur_or_FUend", "case_id_gt_event": "progression"},
+    )
+    metrics["results"] = result_df.to_dict("records")
 
    
     print("result_df", result_df)
@@ -132,31 +143,9 @@ def process_interf0(
         slug="bladder-cancer-tissue-biopsy-whole-slide-image",
     )
 
-    # Fourthly, load your ground truth
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY, dtype={'case_id': str})
-
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]==image_name_bladder_cancer_tissue_biopsy_whole_slide_image[:-4]]
-
-    print('gt_image_name_df',gt_image_name_df)
-
- 
-    gt_image_name_time = gt_image_name_df["time_to_HG_recur_or_FUend"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["progression"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_bladder_cancer_tissue_biopsy_whole_slide_image[:-4],
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
         "case_id_prediction_years_to_recurrence": result_likelihood_of_bladder_cancer_recurrence
     }
 
@@ -23,14 +23,16 @@ Happy programming!
 import json
 from glob import glob
 import random
+import os
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from statistics import mean
 from pathlib import Path
 from pprint import pformat, pprint
 
-import pandas as pd
 import numpy as np
-from sksurv.metrics import concordance_index_censored
+
+from helpers import concordance_index_censored, join_ground_truth, load_ground_truth_index
 
 
 INPUT_DIRECTORY = Path("/input")
@@ -48,22 +50,30 @@ def main():
     metrics = {}
 
 
-    result_df = pd.DataFrame(columns=["case_id", "case_id_gt_time", "case_id_gt_event","case_id_prediction_years_to_recurrence"])
     predictions = read_predictions()
 
+    # Read the ground truth first, so a broken ground truth fails before any job runs
+    ground_truth = load_ground_truth_index(GROUND_TRUTH_DIRECTORY / "ground_truth.csv")
+
 
 
     # We now process each algorithm job for this submission
     # Note that the jobs are not in any order!
     # We work that out from predictions.json
 
-    # Start a number of process workers, using multiprocessing
+    # Start a number of workers, using multiprocessing
     # The optimal number of workers ultimately depends on how many
     # resources each process() would call upon
-    with Pool(processes=4) as pool:
-        metrics["results"] = pool.map(process, predictions)
-    
-    result_df = pd.DataFrame(metrics["results"])
+    with get_pool_class()(processes=4) as pool:
+        results = pool.map(process, predictions)
+
+    # The jobs only gather the predictions, which are then joined to the ground truth at once
+    result_df = join_ground_truth(
+        results,
+        ground_truth=ground_truth,
+        columns={"case_id_gt_time": "follow_up_years", "case_id_gt_event": "event"},
+    )
+    metrics["results"] = result_df.to_dict("records")
     
     survival_times = np.array(result_df["case_id_gt_time"])
     events = np.array(result_df["case_id_gt_event"], dtype=bool)
@@ -122,37 +132,20 @@ def process(job):
 
     #print('image_name_prostatectomy_tissue_whole_slide_image',image_name_prostatectomy_tissue_whole_slide_image)
 
-    # Fourthly, your load your ground truth
-    # Include it in your evaluation container by placing it in ground_truth/
-    ground_truth_df =  pd.read_csv(GROUND_TRUTH_DIRECTORY / "ground_truth.csv")
-
-    gt_image_name_df = ground_truth_df[ground_truth_df["case_id"]==image_name_prostatectomy_tissue_whole_slide_image]
-
-    
-
-    gt_image_name_time = gt_image_name_df["follow_up_years"].item()
-
-    print('gt_image_name_time',gt_image_name_time)
-
-    gt_image_name_event = gt_image_name_df["event"].item()
-
-    print('gt_image_name_event',gt_image_name_event)
-
-
-    
-
-    
-
-
-    # Finally, calculate by comparing the ground truth to the actual results
+    # Finally, return the prediction, main() joins it to the ground truth
     return {
         "case_id": image_name_prostatectomy_tissue_whole_slide_image,
-        "case_id_gt_time": gt_image_name_time, 
-        "case_id_gt_event": gt_image_name_event,
         "case_id_prediction_years_to_recurrence": result_overall_survival_years
     }
 
 
+def get_pool_class():
+    # process() only reads a JSON file, which is I/O bound, so threads do by default;
+    # set GRAND_CHALLENGE_EXECUTION_MODE=process to use processes
+    mode = os.getenv("GRAND_CHALLENGE_EXECUTION_MODE") or "thread"
+    return {"thread": ThreadPool, "process": Pool}[mode]
+
+
 def print_inputs():
     # Just for convenience, in the logs you can then see what files you have to work with
     input_files = [str(x) for x in Path(INPUT_DIRECTORY).rglob("*") if x.is_file()]
@@ -20,14 +20,17 @@ Happy programming!
 """
 import json
 from glob import glob
+import os
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from pprint import pformat, pprint
 
-import pandas as pd
 import numpy as np
 from sklearn.metrics import f1_score, roc_auc_score, roc_curve
 
+from helpers import join_ground_truth, load_ground_truth_index
+
 INPUT_DIRECTORY = Path("/input")
 OUTPUT_DIRECTORY = Path("/output")
 GROUND_TRUTH_DIRECTORY = Path("ground_truth")
@@ -37,13 +40,16 @@ def main():
 
     metrics = {}
 
-    result_df = pd.DataFrame(columns=["case_id", "case_id_gt", "case_id_pred"])
     predictions = read_predictions()
+    # First, so a broken ground truth fails before any job runs
+    ground_truth = load_ground_truth_index(GROUND_TRUTH_DIRECTORY / "ground_truth.csv")
 
-    with Pool(processes=4) as pool:
-        metrics["results"] = pool.map(process, predictions)
-    
-    result_df = pd.DataFrame(metrics["results"])
+    with get_pool_class()(processes=4) as pool:
+        results = pool.map(process, predictions)
+
+    # The jobs only gather the predictions, which are then joined to the ground truth at once
+    result_df = join_ground_truth(results, ground_truth=ground_truth, columns={"case_id_gt": "brs3"})
+    metrics["results"] = result_df.to_dict("records")
     
     y_true = result_df["case_id_gt"].astype(int).values
     y_prob = result_df["case_id_pred"].astype(float).values
@@ -78,18 +84,19 @@ def process(job):
         slug="prostatectomy-tissue-whole-slide-image",
     )
 
-    ground_truth_df = pd.read_csv(GROUND_TRUTH_DIRECTORY / "ground_truth.csv")
-    gt_row = ground_truth_df[ground_truth_df["case_id"] == image_name]
-
-    y_true = gt_row["brs3"].item()
     y_pred = pred_result
 
     return {
         "case_id": image_name,
-        "case_id_gt": y_true,
         "case_id_pred": y_pred
     }
 
+def get_pool_class():
+    # process() only reads a JSON file, which is I/O bound, so threads do by default;
+    # set GRAND_CHALLENGE_EXECUTION_MODE=process to use processes
+    mode = os.getenv("GRAND_CHALLENGE_EXECUTION_MODE") or "thread"
+    return {"thread": ThreadPool, "process": Pool}[mode]
+
 def print_inputs():
     input_files = [str(x) for x in Path(INPUT_DIRECTORY).rglob("*") if x.is_file()]
     print("Input Files:")
@@ -0,0 +1,255 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+
+class PredictionProcessingError(Exception):
+    pass
+
+
+def load_ground_truth_index(path, *, key="case_id"):
+    """
+    Reads a ground truth CSV once into a DataFrame indexed by case_id
+
+    The index is unique, so predictions can be joined to it in one vectorized
+    operation (see join_ground_truth) rather than looked up one by one.
+
+    Parameters
+    ----------
+    path : Path
+        The ground truth CSV.
+
+    key : str
+        The column that identifies a case, read as a string.
+
+    Returns
+    -------
+    The other columns of the ground truth, indexed by key
+    """
+    ground_truth_df = pd.read_csv(path, dtype={key: str})
+
+    duplicated = ground_truth_df[key][ground_truth_df[key].duplicated()]
+    if len(duplicated):
+        raise ValueError(
+            f"Duplicate {key}s in the ground truth {path}: {sorted(set(duplicated))}"
+        )
+
+    return ground_truth_df.set_index(key)
+
+
+def join_ground_truth(results, *, ground_truth, columns, on="case_id"):
+    """
+    Joins the results of all jobs to the ground truth in one go
+
+    This is the second phase of the evaluation: the jobs only gather the
+    predictions, which are then matched to the ground truth by case_id at once.
+    case_ids that are not in the ground truth are reported and stop the
+    evaluation. case_ids that have more than one prediction are reported, each
+    of their predictions is kept.
+
+    Parameters
+    ----------
+    results : list
+        The results of the jobs, dictionaries that hold the case_id in on.
+
+    ground_truth : DataFrame
+        The ground truth, indexed by case_id (see load_ground_truth_index).
+
+    columns : dict
+        The ground truth columns to add to the results, by the names to add
+        them under. They are inserted after on.
+
+    on : str
+        The column of the results to match to the ground truth index.
+
+    Returns
+    -------
+    A DataFrame of the results with the ground truth columns
+    """
+    if not results:
+        raise PredictionProcessingError("There are no predictions to join to the ground truth")
+
+    result_df = pd.DataFrame(results)
+    case_ids = result_df[on]
+
+    positions = ground_truth.index.get_indexer(case_ids)
+    unmatched = sorted(case_ids[positions < 0].unique())
+    duplicated = sorted(case_ids[case_ids.duplicated()].unique())
+
+    print(
+        f"Joined {len(result_df)} predictions to {len(ground_truth)} ground truth cases: "
+        f"{len(unmatched)} unmatched, {len(duplicated)} duplicate {on}s"
+    )
+    for case_id in duplicated:
+        print(f"More than one prediction: {case_id}", file=sys.stderr)
+    if unmatched:
+        for case_id in unmatched:
+            print(f"Not in the ground truth: {case_id}", file=sys.stderr)
+
+        raise PredictionProcessingError(f"{len(unmatched)} unmatched {on}s")
+
+    loc = result_df.columns.get_loc(on) + 1
+    for offset, (name, column) in enumerate(columns.items()):
+        result_df.insert(loc + offset, name, ground_truth[column].to_numpy()[positions])
+
+    return result_df
+
+
+def concordance_index_censored(event_indicator, event_time, estimate, tied_tol=1e-8):
+    """
+    Computes Harrell's concordance index for right-censored survival data
+
+    A replacement for sksurv.metrics.concordance_index_censored that takes
+    O(n log^2 n) rather than O(n^2) time: it has the same comparable pairs, tie
+    handling, errors and return value. A sample with an event is comparable to
+    the samples with a later time and to the censored samples at the same time.
+
+    Parameters
+    ----------
+    event_indicator : array of bool, shape = (n_samples,)
+        Whether each sample experienced an event (True) or was censored.
+
+    event_time : array of float, shape = (n_samples,)
+        The time of the event or of censoring.
+
+    estimate : array of float, shape = (n_samples,)
+        The risk scores, higher for samples with an earlier event.
+
+    tied_tol : float
+        Risk scores that differ by at most this much are tied.
+
+    Returns
+    -------
+    The concordance index, then the numbers of concordant, discordant and
+    risk-tied comparable pairs and of comparable pairs with tied times
+    """
+    event_indicator, event_time, estimate = _check_concordance_inputs(
+        event_indicator, event_time, estimate
+    )
+    n_samples = len(event_time)
+
+    # Order by time, events before censored samples at the same time: the samples
+    # comparable to an event then follow the events at its time
+    order = np.lexsort((~event_indicator, event_time))
+    event_time = event_time[order]
+    event_indicator = event_indicator[order]
+    estimate = estimate[order]
+
+    time_starts = np.flatnonzero(np.r_[True, event_time[1:] != event_time[:-1]])
+    time_sizes = np.diff(np.r_[time_starts, n_samples])
+    time_events = np.add.reduceat(event_indicator.astype(np.int64), time_starts)
+    tied_time = int(np.sum(time_events * (time_sizes - time_events)))
+
+    # An event alone at the last time has no comparable samples
+    if time_sizes[-1] == 1 and event_indicator[-1]:
+        event_indicator[-1] = False
+    if not event_indicator.any():
+        raise ValueError("Data has no comparable pairs, cannot estimate concordance index.")
+
+    events = np.flatnonzero(event_indicator)
+    time_index = np.searchsorted(time_starts, events, side="right") - 1
+    comparable_start = time_starts[time_index] + time_events[time_index]
+    comparable = n_samples - comparable_start
+
+    # Risk scores as ranks among the distinct scores, and for each event the ranks
+    # of the scores it is tied with
+    values = np.unique(estimate)
+    ranks = np.searchsorted(values, estimate)
+    lower = _get_tie_bound(values, estimate[events], ranks[events], tied_tol=tied_tol, side="lower")
+    upper = _get_tie_bound(values, estimate[events], ranks[events], tied_tol=tied_tol, side="upper")
+
+    # Counts of the comparable samples with a rank below lower and up to upper
+    bounds = np.concatenate([lower, upper + 1])
+    before = np.concatenate([comparable_start, comparable_start])
+    below = np.r_[0, np.cumsum(np.bincount(ranks))]
+    below = below[bounds] - _count_ranks_below(ranks, before=before, bounds=bounds, below=below)
+    lower_count, upper_count = below[: len(events)], below[len(events) :]
+
+    concordant = int(np.sum(lower_count))
+    tied_risk = int(np.sum(upper_count - lower_count))
+    discordant = int(np.sum(comparable - upper_count))
+    denominator = np.float64(np.sum(comparable))
+
+    cindex = (concordant + 0.5 * tied_risk) / denominator
+    return cindex, concordant, discordant, tied_risk, tied_time
+
+
+def _check_concordance_inputs(event_indicator, event_time, estimate):
+    # The checks of sksurv.metrics.concordance_index_censored
+    arrays = {
+        "event_indicator": np.asarray(event_indicator),
+        "event_time": np.asarray(event_time),
+        "estimate": np.asarray(estimate),
+    }
+    for name, array in arrays.items():
+        if array.ndim != 1:
+            raise ValueError(f"Expected 1D array for {name}, got {array.ndim}D array instead")
+    lengths = {len(array) for array in arrays.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Found input variables with inconsistent numbers of samples: {sorted(lengths)}")
+    for name, array in arrays.items():
+        if array.dtype.kind not in "fc":
+            continue
+        if np.isnan(array).any():
+            raise ValueError(f"Input {name} contains NaN.")
+        if np.isinf(array).any():
+            raise ValueError(f"Input {name} contains infinity or a value too large for {array.dtype!r}.")
+
+    event_indicator, event_time, estimate = arrays.values()
+    if not np.issubdtype(event_indicator.dtype, np.bool_):
+        raise ValueError(
+            f"only boolean arrays are supported as class labels for survival analysis, got {event_indicator.dtype}"
+        )
+    if len(event_time) < 2:
+        raise ValueError("Need a minimum of two samples")
+    if not event_indicator.any():
+        raise ValueError("All samples are censored")
+
+    return event_indicator, event_time, estimate
+
+
+def _get_tie_bound(values, estimate, ranks, *, tied_tol, side):
+    # The lowest (or highest) rank of the distinct values within tied_tol of each estimate,
+    # with the same comparison as sksurv, so rounding cannot move a tie across the bound
+    if side == "lower":
+        bound = np.minimum(np.searchsorted(values, estimate - tied_tol, side="left"), ranks)
+        step = -1
+    else:
+        bound = np.maximum(np.searchsorted(values, estimate + tied_tol, side="right") - 1, ranks)
+        step = 1
+
+    while True:
+        # Move outwards while the next value is tied, inwards while this one is not
+        outer = np.clip(bound + step, 0, len(values) - 1)
+        move_out = (outer != bound) & (np.absolute(values[outer] - estimate) <= tied_tol)
+        move_in = np.absolute(values[bound] - estimate) > tied_tol
+        if not (move_out.any() or move_in.any()):
+            return bound
+        bound = bound + step * move_out - step * move_in
+
+
+def _count_ranks_below(ranks, *, before, bounds, below):
+    # For each query q, the number of ranks[:before[q]] that are below bounds[q]
+    #
+    # This is binary indexed (Fenwick) tree counting, done offline for all queries: the
+    # ranks below a bound fall into at most one block of 2**level ranks per level, one
+    # for each set bit of the bound. Each level is one vectorized pass over the queries,
+    # after sorting the samples by block: O(n log n) per level, for log n levels.
+    # below[r] is the number of all ranks below r.
+    n_samples = len(ranks)
+    positions = np.arange(n_samples, dtype=np.int64)
+    ranks = ranks.astype(np.int64)
+    counts = np.zeros(len(bounds), dtype=np.int64)
+    for level in range(int(bounds.max()).bit_length()):
+        # Positions grouped by block, in order within a block
+        keys = np.sort((ranks >> level) * n_samples + positions)
+
+        query = np.flatnonzero((bounds >> level) & 1)
+        block = (bounds[query] >> level) - 1
+        needles = block * n_samples + before[query]
+        # Sorted needles make the binary searches cache friendly
+        order = np.argsort(needles)
+        counts[query[order]] += np.searchsorted(keys, needles[order])
+        counts[query] -= below[block << level]
+    return counts
@@ -0,0 +1,98 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sksurv_metrics = pytest.importorskip("sksurv.metrics")
+
+EVALUATION = Path(__file__).resolve().parent.parent
+# The copies of the concordance index: of the tasks, and of c-index.py
+HELPERS = {
+    "Task_1": EVALUATION / "Task_1" / "helpers.py",
+    "Task_3": EVALUATION / "Task_3" / "helpers.py",
+    "standalone": EVALUATION / "helpers.py",
+}
+
+
+def load_helpers(name):
+    spec = importlib.util.spec_from_file_location(f"{name.lower()}_helpers", HELPERS[name])
+    helpers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(helpers)
+    return helpers
+
+
+def concordance_or_error(fn, *args, **kwargs):
+    try:
+        cindex, *counts = fn(*args, **kwargs)
+    except ValueError as error:
+        return str(error)
+    return cindex, [int(count) for count in counts]
+
+
+@pytest.mark.parametrize("task", HELPERS)
+def test_matches_sksurv_on_random_data(task):
+    concordance_index_censored = load_helpers(task).concordance_index_censored
+    rng = np.random.default_rng(0)
+
+    for trial in range(300):
+        n_samples = int(rng.integers(2, 200))
+        # Few distinct times and risk scores, so there are many ties
+        event_time = rng.integers(0, rng.integers(1, 20), n_samples).astype(float)
+        event_indicator = rng.random(n_samples) < rng.random()
+        if trial % 3 == 0:
+            estimate = rng.integers(0, 5, n_samples).astype(float)
+        elif trial % 3 == 1:
+            estimate = rng.random(n_samples) + rng.choice([0, 5e-9, 2e-8], n_samples)
+        else:
+            estimate = rng.normal(size=n_samples)
+        tied_tol = (1e-8, 0.0, 0.1)[trial % 3]
+
+        expected = concordance_or_error(
+            sksurv_metrics.concordance_index_censored,
+            event_indicator,
+            event_time,
+            estimate,
+            tied_tol=tied_tol,
+        )
+        actual = concordance_or_error(
+            concordance_index_censored,
+            event_indicator,
+            event_time,
+            estimate,
+            tied_tol=tied_tol,
+        )
+        np.testing.assert_equal(actual, expected, err_msg=f"trial {trial}")
+
+
+@pytest.mark.parametrize("task", HELPERS)
+@pytest.mark.parametrize(
+    "event_indicator, event_time, estimate",
+    [
+        ([False, False, False], [1.0, 2.0, 3.0], [0.1, 0.2, 0.3]),  # All censored
+        ([True], [1.0], [0.1]),  # One sample
+        ([False, True], [1.0, 2.0], [0.1, 0.2]),  # No comparable pairs
+        ([1, 0, 1], [1.0, 2.0, 3.0], [0.1, 0.2, 0.3]),  # Not boolean
+        ([True, False], [1.0, np.nan], [0.1, 0.2]),  # NaN
+        ([True, False], [1.0, 2.0], [np.inf, 0.2]),  # Infinity
+    ],
+)
+def test_matches_sksurv_errors(task, event_indicator, event_time, estimate):
+    concordance_index_censored = load_helpers(task).concordance_index_censored
+    args = (np.asarray(event_indicator), np.asarray(event_time), np.asarray(estimate))
+
+    expected = concordance_or_error(sksurv_metrics.concordance_index_censored, *args)
+    assert isinstance(expected, str)
+    assert concordance_or_error(concordance_index_censored, *args) == expected
+
+
+@pytest.mark.parametrize("task", HELPERS)
+def test_matches_sksurv_without_comparable_samples(task):
+    # Events that are only tied in time with each other compare to no sample at all
+    concordance_index_censored = load_helpers(task).concordance_index_censored
+    args = (np.array([True, True, False]), np.array([1.0, 1.0, 0.5]), np.array([0.1, 0.2, 0.3]))
+
+    with np.errstate(invalid="ignore"):
+        expected = concordance_or_error(sksurv_metrics.concordance_index_censored, *args)
+        actual = concordance_or_error(concordance_index_censored, *args)
+    np.testing.assert_equal(actual, expected)
@@ -0,0 +1,78 @@
+import importlib.util
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+EVALUATION = Path(__file__).resolve().parent.parent
+
+# The copies of join_ground_truth: of the tasks, and of c-index.py and f1.py
+HELPERS = {
+    "Task_1": EVALUATION / "Task_1" / "helpers.py",
+    "Task_2": EVALUATION / "Task_2" / "helpers.py",
+    "Task_3": EVALUATION / "Task_3" / "helpers.py",
+    "standalone": EVALUATION / "helpers.py",
+}
+
+
+def load_helpers(name):
+    spec = importlib.util.spec_from_file_location(f"{name.lower()}_helpers", HELPERS[name])
+    helpers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(helpers)
+    return helpers
+
+
+@pytest.fixture
+def ground_truth_path(tmp_path):
+    path = tmp_path / "ground_truth.csv"
+    path.write_text("case_id,event\n001,1\n002,0\n003,1\n")
+    return path
+
+
+@pytest.mark.parametrize("name", HELPERS)
+def test_joins_ground_truth_after_case_id(name, ground_truth_path):
+    helpers = load_helpers(name)
+    ground_truth = helpers.load_ground_truth_index(ground_truth_path)
+
+    result_df = helpers.join_ground_truth(
+        [{"case_id": "003", "prediction": 0.3}, {"case_id": "001", "prediction": 0.1}],
+        ground_truth=ground_truth,
+        columns={"case_id_gt": "event"},
+    )
+
+    assert list(result_df.columns) == ["case_id", "case_id_gt", "prediction"]
+    assert result_df["case_id_gt"].tolist() == [1, 1]
+
+
+@pytest.mark.parametrize("name", HELPERS)
+def test_keeps_duplicate_predictions(name, ground_truth_path, capsys):
+    helpers = load_helpers(name)
+    ground_truth = helpers.load_ground_truth_index(ground_truth_path)
+
+    result_df = helpers.join_ground_truth(
+        [{"case_id": "002"}, {"case_id": "002"}],
+        ground_truth=ground_truth,
+        columns={"case_id_gt": "event"},
+    )
+
+    assert len(result_df) == 2
+    assert "More than one prediction: 002" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("name", HELPERS)
+@pytest.mark.parametrize("results", [[], [{"case_id": "004"}]])
+def test_unmatched_or_no_predictions_fail(name, results, ground_truth_path):
+    helpers = load_helpers(name)
+    ground_truth = helpers.load_ground_truth_index(ground_truth_path)
+
+    with pytest.raises(helpers.PredictionProcessingError):
+        helpers.join_ground_truth(results, ground_truth=ground_truth, columns={"case_id_gt": "event"})
+
+
+@pytest.mark.parametrize("name", HELPERS)
+def test_duplicate_ground_truth_fails(name, tmp_path):
+    path = tmp_path / "ground_truth.csv"
+    pd.DataFrame({"case_id": ["001", "001"], "event": [1, 0]}).to_csv(path, index=False)
+
+    with pytest.raises(ValueError, match="001"):
+        load_helpers(name).load_ground_truth_index(path)
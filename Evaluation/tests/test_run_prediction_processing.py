@@ -0,0 +1,49 @@
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+EVALUATION = Path(__file__).resolve().parent.parent
+TASKS = ("Task_1", "Task_2", "Task_3")
+
+SCRIPT = textwrap.dedent(
+    """
+    import sys
+    import time
+
+    sys.path.insert(0, sys.argv[1])
+    import helpers
+
+
+    def fn(prediction):
+        if prediction["pk"] == 3:
+            raise RuntimeError("failing prediction")
+        time.sleep(0.001)
+        return prediction["pk"]
+
+
+    try:
+        helpers.run_prediction_processing(
+            fn=fn,
+            predictions=[{"pk": pk} for pk in range(200)],
+            mode=sys.argv[2],
+        )
+    except helpers.PredictionProcessingError:
+        sys.exit(3)
+    """
+)
+
+
+@pytest.mark.parametrize("mode", ["thread", "process"])
+@pytest.mark.parametrize("task", TASKS)
+def test_failing_prediction_exits(task, mode):
+    # The pool used to hang at interpreter exit in about half of the runs
+    for _ in range(4):
+        completed = subprocess.run(
+            [sys.executable, "-c", SCRIPT, str(EVALUATION / task), mode],
+            capture_output=True,
+            timeout=60,
+        )
+        assert completed.returncode == 3, completed.stderr.decode()
@@ -0,0 +1,271 @@
+"""
+Benchmarks the input loaders of an inference container on synthetic data
+
+Generates pyramidal tiled TIFFs with matching tissue masks and .mha volumes of
+increasing size, then times the loaders of the container's inference.py on them.
+Every measurement runs in a fresh process, so the reported peak memory is that
+of the loader alone, and loader results are read in full. Everything runs
+offline on Linux; only PyVips, NumPy and SimpleITK (and the requirements of the
+container) are needed.
+
+Usage:
+
+  python benchmarks/benchmark_loaders.py --container CHIMERA-prostate-survival
+
+Reports seconds, throughput in megapixels (or megavoxels) per second and peak
+memory per loader and size, so the rows of a loader form its scaling curve.
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy
+import pyvips
+import SimpleITK
+
+REPOSITORY_PATH = Path(__file__).resolve().parent.parent
+
+
+def make_wsi(directory, *, size, tile_size, compression):
+    """
+    Writes a synthetic RGB slide of size x size pixels as a pyramidal tiled TIFF,
+    with a tissue mask of the same size (an ellipse) in a folder next to it
+
+    Returns the folders of the slide and of the mask, as loaders expect a socket folder.
+    """
+    slide_directory = directory / f"wsi-{size}-{compression}"
+    mask_directory = directory / f"wsi-{size}-{compression}-mask"
+    slide_path = slide_directory / "slide.tif"
+    mask_path = mask_directory / "mask.tif"
+    if slide_path.exists() and mask_path.exists():
+        return slide_directory, mask_directory
+
+    slide_directory.mkdir(parents=True, exist_ok=True)
+    mask_directory.mkdir(parents=True, exist_ok=True)
+
+    # Noise compresses like texture does, unlike a flat image
+    bands = [
+        pyvips.Image.gaussnoise(size, size, mean=mean, sigma=40).cast("uchar")
+        for mean in (200, 120, 180)
+    ]
+    slide = bands[0].bandjoin(bands[1:]).copy(interpretation="srgb")
+    slide.tiffsave(
+        str(slide_path),
+        tile=True,
+        pyramid=True,
+        tile_width=tile_size,
+        tile_height=tile_size,
+        compression=compression,
+        bigtiff=True,
+    )
+
+    xy = pyvips.Image.xyz(size, size)
+    centre = size / 2
+    distance = ((xy[0] - centre) ** 2 + ((xy[1] - centre) * 1.5) ** 2) ** 0.5
+    mask = (distance < size * 0.4).ifthenelse(1, 0).cast("uchar")
+    mask.tiffsave(
+        str(mask_path),
+        tile=True,
+        pyramid=True,
+        tile_width=tile_size,
+        tile_height=tile_size,
+        compression="deflate",
+        bigtiff=True,
+    )
+    return slide_directory, mask_directory
+
+
+def make_mha(directory, *, shape, compressed):
+    """Writes a synthetic int16 MRI volume of shape (z, y, x) as .mha, returns its folder"""
+    name = "x".join(str(n) for n in shape)
+    volume_directory = directory / f"mha-{name}-{'compressed' if compressed else 'raw'}"
+    volume_path = volume_directory / "volume.mha"
+    if volume_path.exists():
+        return volume_directory
+
+    volume_directory.mkdir(parents=True, exist_ok=True)
+    rng = numpy.random.default_rng(0)
+    image = SimpleITK.GetImageFromArray(rng.integers(0, 2000, shape, dtype=numpy.int16))
+    image.SetSpacing((0.5, 0.5, 3.0))
+    SimpleITK.WriteImage(image, str(volume_path), useCompression=compressed)
+    return volume_directory
+
+
+def read_memory_mb():
+    # The resident and peak resident memory of this process (Linux)
+    # Unlike ru_maxrss, VmHWM does not carry over the peak of the parent of a spawned process
+    with open("/proc/self/status") as f:
+        fields = dict(line.split(":", 1) for line in f)
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+
+
+def consume(result):
+    # Reads a loader result in full, so loaders that defer reading (memory-mapped volumes,
+    # tile generators) are timed for the same work as the others
+    if hasattr(result, "array"):
+        result = result.array
+    if isinstance(result, numpy.ndarray):
+        if result.dtype.names is None:
+            result.max()
+    elif not isinstance(result, pyvips.Image):
+        for _ in result:
+            pass
+
+
+def measure(*, container, loader, kwargs, repeats):
+    # Runs in a fresh process: times a loader of the container and records its peak memory
+    sys.path.insert(0, str(container))
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import inference
+
+        function = getattr(inference, loader)
+        baseline, _ = read_memory_mb()
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            consume(function(**kwargs))
+            seconds.append(time.perf_counter() - start)
+        _, peak = read_memory_mb()
+
+    return dict(seconds=seconds, peak_mb=peak - baseline)
+
+
+def run_benchmark(*, container, loader, kwargs, pixels, repeats, label):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        result = pool.apply(
+            measure,
+            kwds=dict(container=container, loader=loader, kwargs=kwargs, repeats=repeats),
+        )
+
+    best = min(result["seconds"])
+    row = dict(
+        loader=loader,
+        input=label,
+        megapixels=round(pixels / 1e6, 2),
+        first_seconds=round(result["seconds"][0], 4),
+        median_seconds=round(statistics.median(result["seconds"]), 4),
+        best_seconds=round(best, 4),
+        megapixels_per_second=round(pixels / 1e6 / best, 1),
+        peak_mb=round(result["peak_mb"], 1),
+    )
+    print(
+        f"{loader:34} {label:28} {row['megapixels']:>9} MPix "
+        f"{row['best_seconds']:>9.4f} s {row['megapixels_per_second']:>9} MPix/s "
+        f"{row['peak_mb']:>8} MB peak"
+    )
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the input loaders of an inference container on synthetic data"
+    )
+    parser.add_argument(
+        "--container",
+        type=Path,
+        default=REPOSITORY_PATH / "CHIMERA-prostate-survival",
+        help="folder with the inference.py and helpers.py to benchmark",
+    )
+    parser.add_argument(
+        "--wsi-sizes",
+        type=int,
+        nargs="+",
+        default=[2048, 4096, 8192],
+        help="widths (and heights) of the synthetic slides in pixels",
+    )
+    parser.add_argument("--tile-size", type=int, default=256, help="TIFF tile size")
+    parser.add_argument(
+        "--compression",
+        default="jpeg",
+        choices=["jpeg", "deflate", "lzw", "none"],
+        help="compression of the synthetic slides",
+    )
+    parser.add_argument(
+        "--mha-shapes",
+        nargs="+",
+        default=["24x256x256", "48x512x512", "96x768x768"],
+        help="(z, y, x) shapes of the synthetic volumes, such as 24x256x256",
+    )
+    parser.add_argument(
+        "--array-max-size",
+        type=int,
+        default=4096,
+        help="largest slide loaded in full with load_image_file_as_array",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="runs per measurement")
+    parser.add_argument(
+        "--fixtures",
+        type=Path,
+        help="folder for the synthetic data, which is reused between runs (default: a temporary folder)",
+    )
+    parser.add_argument("--output", type=Path, help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with contextlib.ExitStack() as stack:
+        fixtures = args.fixtures or Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        print(f"Generating synthetic data in {fixtures}")
+
+        benchmarks = []
+        for size in args.wsi_sizes:
+            slide, mask = make_wsi(
+                fixtures, size=size, tile_size=args.tile_size, compression=args.compression
+            )
+            label = f"{size}x{size} {args.compression}"
+            if size <= args.array_max_size:
+                benchmarks.append(("load_image_file_as_array", dict(location=slide), size * size, label))
+            benchmarks += [
+                ("load_image_file_as_thumbnail", dict(location=slide), size * size, label),
+                (
+                    "load_image_file_as_tiles",
+                    dict(location=slide, tile_size=args.tile_size),
+                    size * size,
+                    label,
+                ),
+                (
+                    "load_tissue_tile_index",
+                    dict(location=slide, mask_location=mask, tile_size=args.tile_size),
+                    size * size,
+                    label,
+                ),
+            ]
+
+        for shape in args.mha_shapes:
+            shape = tuple(int(n) for n in shape.split("x"))
+            for compressed in (False, True):
+                volume = make_mha(fixtures, shape=shape, compressed=compressed)
+                label = f"{'x'.join(map(str, shape))} {'compressed' if compressed else 'raw'}"
+                voxels = shape[0] * shape[1] * shape[2]
+                benchmarks += [
+                    ("load_image_file_as_array", dict(location=volume), voxels, label),
+                    ("load_image_file_as_volume", dict(location=volume), voxels, label),
+                ]
+
+        rows = [
+            run_benchmark(
+                container=args.container.resolve(),
+                loader=loader,
+                kwargs=kwargs,
+                pixels=pixels,
+                repeats=args.repeats,
+                label=label,
+            )
+            for loader, kwargs, pixels, label in benchmarks
+        ]
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,16 @@
+import filecmp
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+CONTAINERS = ("CHIMERA-bladder-brs", "CHIMERA-bladder-survival", "CHIMERA-prostate-survival")
+
+
+@pytest.mark.parametrize("container", CONTAINERS[1:])
+def test_helpers_are_identical(container):
+    # Every container ships the same helpers.py: edit one and copy it to the others
+    reference = ROOT / CONTAINERS[0] / "helpers.py"
+    assert filecmp.cmp(reference, ROOT / container / "helpers.py", shallow=False), (
+        f"{container}/helpers.py differs from {reference.relative_to(ROOT)}"
+    )